@@ -1,37 +1,54 @@
 #!/usr/bin/env python3
 """
-Clean each capnp recording of any unfinished writing as it will crash otherwise
+Clean each capnp recording of any unfinished writing as it will crash otherwise. Only the
+message framing is scanned and each topic file is truncated in place after its last complete
+message, so no message is ever deserialized or copied.
 """
 import argparse
-from multiprocessing import Process
+from multiprocessing import Pool
 from pathlib import Path
-from shutil import copyfile
+import time
+import derp.recording
 import derp.util
 
 
-def clean(topic, path, tmp_path):
-    """ Cleaning is simply the act of writing only complete messages """
-    copyfile(path, tmp_path)
-    with open(tmp_path, 'rb') as topic_reader, open(path, 'wb') as topic_writer:
-        for msg in derp.util.TOPICS[topic].read_multiple(topic_reader):
-            msg.as_builder().write(topic_writer)
-            topic_writer.flush()
+def clean(args):
+    """ Find the end of a topic's complete messages and truncate there unless only checking """
+    folder, topic, check = args
+    size = (folder / (topic + '.bin')).stat().st_size
+    if check:
+        end = derp.recording.topic_end(folder, topic)
+    else:
+        end = size - derp.recording.truncate_torn(folder, topic)
+    return folder, topic, size, end
 
 
 def main():
-    """ Create a process for each cleaning """
+    """ Scan every topic of every recording in parallel and report what was kept and cut """
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument("path", type=Path, help="location of a recording")
+    parser.add_argument("paths", type=Path, nargs='+', help="locations of recordings")
+    parser.add_argument("--check", action='store_true', help="only report, do not truncate")
+    parser.add_argument("--count", type=int, default=4, help="parallel processes to scan with")
     args = parser.parse_args()
 
-    for topic in derp.util.TOPICS:
-        path = args.path / (topic + '.bin')
-        tmp_path = args.path / (topic + '.bin.bak')
-        if path.exists():
-            proc = Process(target=clean, name=topic, args=(topic, path, tmp_path))
-            proc.start()
-            proc.join()
-        tmp_path.unlink()
+    tasks = [
+        (path, topic, args.check)
+        for path in args.paths
+        for topic in derp.util.TOPICS
+        if (path / (topic + '.bin')).exists()
+    ]
+    start_time = time.time()
+    total_kept, total_cut = 0, 0
+    with Pool(args.count) as pool:
+        for folder, topic, size, end in pool.imap_unordered(clean, tasks):
+            total_kept += end
+            total_cut += size - end
+            if size > end:
+                print("%s %-10s kept %12i bytes, %s %i torn bytes" %
+                      (folder.name, topic, end, 'found' if args.check else 'cut', size - end))
+    print("%i topics, %i bytes recovered intact, %i torn bytes %s in %.1fs" %
+          (len(tasks), total_kept, total_cut, 'found' if args.check else 'cut',
+           time.time() - start_time))
 
 
 if __name__ == "__main__":
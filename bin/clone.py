@@ -4,44 +4,70 @@ Clone builds a cloning dataset and runs a training run over it. We combine these
 datasets tend to be pretty small so it's simpler to just have all the code together.
 """
 import argparse
+import hashlib
+import json
 from pathlib import Path
 import multiprocessing
+import shutil
 import time
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
-from derp.fetcher import Fetcher
+from derp.fetcher import Fetcher, make_loader
+import derp.recording
+import derp.inference
 import derp.util
 import derp.model
 
+# The build config that changes what a recording's dataset contains
+BUILD_KEYS = ['n_samples', 'perturbs', 'format', 'reduce']
+# Bumped whenever the same config would build a different dataset, such as new random streams
+BUILD_VERSION = 2
 
-def build_recording(config, recording_folder, out_folder, do_perturb):
+
+def build_chunk(config, recording_folder, out_folder, do_perturb, first, last):
     """
-    For each frame in the video generate frames and perturbations to save into a dataset.
+    For each frame in [first, last) of the video generate frames and perturbations to save into
+    a dataset. Images are saved straight into out_folder while packed thumbs go to a part file
+    that merge_chunks combines. Returns the predict and status rows of every thumb.
     """
     camera_config = derp.util.load_config(recording_folder / 'config.yaml')['camera']
-    predict_fd = open(str(out_folder / 'predict.csv'), 'w')
-    status_fd = open(str(out_folder / 'status.csv'), 'w')
 
-    topics = derp.util.load_topics(recording_folder)
-    assert 'quality' in topics and topics['quality']
+    camera_reader = derp.recording.TopicReader(recording_folder, 'camera')
+    qualities = derp.recording.load_columns(recording_folder, 'quality')['quality']
+    assert len(qualities)
+    good = derp.util.TOPICS['quality'].QualityEnum.good
 
-    actions = derp.util.extract_car_actions(topics)
-    camera = {'times': [msg.publishNS for msg in topics['camera']]}
+    actions = derp.recording.load_car_actions(recording_folder)
+    camera = {'times': camera_reader.times}
     camera['speed'] = derp.util.extract_latest(camera['times'], actions[:, 0], actions[:, 1])
     camera['steer'] = derp.util.extract_latest(camera['times'], actions[:, 0], actions[:, 2])
 
     bbox = derp.util.get_patch_bbox(config['thumb'], camera_config)
     size = (config['thumb']['width'], config['thumb']['height'])
-    n_frames_processed = 0
-    for camera_i, timestamp in enumerate(camera['times']):
-        if topics['quality'][camera_i].quality != 'good':
+
+    # Optionally let libjpeg decode straight to a smaller frame that still covers the thumb
+    reduction = derp.util.jpg_reduction(bbox, size) if config['build'].get('reduce') else 1
+    decode_config = derp.util.reduce_config(camera_config, reduction)
+    decode_bbox = derp.util.get_patch_bbox(config['thumb'], decode_config)
+    if decode_bbox is None:
+        reduction, decode_config, decode_bbox = 1, camera_config, bbox
+
+    n_samples = config['build']['n_samples'] if do_perturb else 1
+    is_packed = config['build'].get('format', 'png') == 'packed'
+    thumbs = []
+    rows = []
+    for camera_i in range(first, last):
+        timestamp = camera['times'][camera_i]
+        if qualities[camera_i] != good:
             continue
-        for perturb_i in range(config['build']['n_samples'] if do_perturb else 1):
+        frame = derp.util.decode_jpg(camera_reader[camera_i].jpg, reduction)
+        for perturb_i in range(n_samples):
             store_name = '%i_%03i.png' % (timestamp, perturb_i)
 
-            shift = np.random.uniform(*config['build']['perturbs']['shift']['range'])
-            rotate = np.random.uniform(*config['build']['perturbs']['rotate']['range'])
+            # Every sample has its own stream so chunking and worker count don't matter
+            rng = derp.util.sample_rng(config['seed'], recording_folder.name, camera_i, perturb_i)
+            shift = rng.uniform(*config['build']['perturbs']['shift']['range'])
+            rotate = rng.uniform(*config['build']['perturbs']['rotate']['range'])
 
             predict = [store_name]
             skip = False
@@ -60,39 +86,174 @@ def build_recording(config, recording_folder, out_folder, do_perturb):
             for status_config in config['status']:
                 status.append(float(camera[status_config['field']][camera['index']]))
 
-            frame = derp.util.decode_jpg(topics['camera'][camera_i].jpg)
-            derp.util.perturb(frame, camera_config, shift, rotate)
-            patch = derp.util.crop(frame, bbox)
+            patch = derp.util.perturb_patch(frame, decode_config, decode_bbox, shift, rotate)
             thumb = derp.util.resize(patch, size)
-            derp.util.save_image(out_folder / store_name, thumb)
-                
-            predict_row = ['%.6f' % x if isinstance(x, float) else x for x in predict]
-            predict_fd.write(','.join(predict_row) + '\n')
-            status_row = ['%.6f' % x if isinstance(x, float) else x for x in status]
-            status_fd.write(','.join(status_row) + '\n')
-        n_frames_processed += 1
-    print('Build %5i %s' % (n_frames_processed, out_folder))
-    predict_fd.close()
-    status_fd.close()
-    return True
+            if is_packed:
+                thumbs.append(thumb)
+            else:
+                derp.util.save_image(out_folder / store_name, thumb)
+            rows.append((predict, status))
+    if is_packed:
+        thumb_shape = (config['thumb']['height'], config['thumb']['width'],
+                       config['thumb']['depth'])
+        thumbs = np.array(thumbs, dtype=np.uint8).reshape((len(thumbs), *thumb_shape))
+        np.save(str(part_path(out_folder, first)), thumbs)
+    return rows
+
+
+def part_path(out_folder, first):
+    return out_folder / ('part-%09i.npy' % first)
+
+
+def merge_chunks(config, out_folder, chunks):
+    """
+    Write the rows of each (first, rows) chunk, in frame order, as one dataset. Packed part
+    files are copied into a single thumbs array and removed.
+    """
+    chunks = sorted(chunks, key=lambda chunk: chunk[0])
+    rows = [row for _, chunk_rows in chunks for row in chunk_rows]
+    if config['build'].get('format', 'png') == 'packed':
+        thumb_shape = (config['thumb']['height'], config['thumb']['width'],
+                       config['thumb']['depth'])
+        thumbs = np.lib.format.open_memmap(str(out_folder / 'thumbs.npy'), mode='w+',
+                                           dtype=np.uint8, shape=(len(rows), *thumb_shape))
+        n_items_merged = 0
+        for first, _ in chunks:
+            part = np.load(str(part_path(out_folder, first)))
+            thumbs[n_items_merged : n_items_merged + len(part)] = part
+            n_items_merged += len(part)
+            part_path(out_folder, first).unlink()
+        assert n_items_merged == len(rows)
+        thumbs.flush()
+        predicts = np.array([predict[1:] for predict, _ in rows], dtype=np.float32)
+        predicts = predicts.reshape(len(rows), len(config['predict']))
+        statuses = np.array([status[1:] for _, status in rows], dtype=np.float32)
+        statuses = statuses.reshape(len(rows), len(config['status']))
+        np.save(str(out_folder / 'predict.npy'), predicts)
+        np.save(str(out_folder / 'status.npy'), statuses)
+        return
+    with open(str(out_folder / 'predict.csv'), 'w') as predict_fd:
+        with open(str(out_folder / 'status.csv'), 'w') as status_fd:
+            for predict, status in rows:
+                predict_row = ['%.6f' % x if isinstance(x, float) else x for x in predict]
+                predict_fd.write(','.join(predict_row) + '\n')
+                status_row = ['%.6f' % x if isinstance(x, float) else x for x in status]
+                status_fd.write(','.join(status_row) + '\n')
+
+
+def build_chunk_fn(args):
+    """ Build a chunk, returning which chunk it was along with its rows """
+    return args[1], args[4], build_chunk(*args)
+
+
+def finish_recording(config, recording_folder, out_folder, manifest, n_chunks, chunks):
+    """ Merge the built chunks, then mark the recording complete by writing its manifest """
+    assert len(chunks) == n_chunks
+    merge_chunks(config, out_folder, chunks)
+    derp.util.dump_config(manifest, out_folder / 'manifest.yaml')
+    print('Build %5i %s' % (sum(len(rows) for _, rows in chunks), recording_folder.stem))
+
+
+def recording_manifest(config, recording_folder, do_perturb):
+    """ Everything that the dataset built from a recording depends on """
+    files = {}
+    topic_paths = sorted(recording_folder.glob('*.bin')) + sorted(recording_folder.glob('*.zst'))
+    for path in topic_paths + [recording_folder / 'config.yaml']:
+        stat = path.stat()
+        files[path.name] = [stat.st_size, stat.st_mtime_ns]
+    return {
+        'version': BUILD_VERSION,
+        'recording': recording_folder.name,
+        'files': files,
+        'seed': config['seed'],
+        'perturb': do_perturb,
+        'build': {key: config['build'].get(key) for key in BUILD_KEYS},
+        'thumb': config['thumb'],
+        'status': config['status'],
+        'predict': config['predict'],
+    }
+
+
+def manifest_key(manifest):
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
 
 
-def build_recording_fn(args):
-    return build_recording(*args)
+def link_dataset(out_folder, dataset_folder):
+    """ Point an experiment's recording folder at a shared dataset folder """
+    if out_folder.is_symlink():
+        out_folder.unlink()
+    elif out_folder.exists():
+        shutil.rmtree(str(out_folder))
+    out_folder.parent.mkdir(parents=True, exist_ok=True)
+    out_folder.symlink_to(dataset_folder, target_is_directory=True)
 
 
 def build(config, experiment_path, count):
-    """ Build the dataset """
-    np.random.seed(config['seed'])
+    """
+    Build the dataset. Each recording is built once into a shared folder keyed by its manifest,
+    so only recordings whose files or relevant config changed are rebuilt, and experiments
+    with the same settings reuse each other's builds.
+    """
     process_args = []
-    for i, recording_folder in enumerate(derp.util.RECORDING_ROOT.glob('recording-*-*-*')):
+    out_folders = set()
+    recording_folders = sorted(derp.util.RECORDING_ROOT.glob('recording-*-*-*'))
+    for i, recording_folder in enumerate(recording_folders):
         partition = 'train' if i % config['build']['train_mod'] else 'test'
+        manifest = recording_manifest(config, recording_folder, partition == 'train')
+        dataset_folder = derp.util.DATASET_ROOT / manifest_key(manifest)
         out_folder = experiment_path / partition / recording_folder.stem
-        if not out_folder.exists():
-            out_folder.mkdir(parents=True)
-            process_args.append([config, recording_folder, out_folder, partition == 'train'])
-    pool = multiprocessing.Pool(count)
-    pool.map(build_recording_fn, process_args)
+        link_dataset(out_folder, dataset_folder)
+        out_folders.add(out_folder)
+        if (dataset_folder / 'manifest.yaml').exists():
+            continue
+        if dataset_folder.exists():
+            shutil.rmtree(str(dataset_folder))
+        dataset_folder.mkdir(parents=True)
+        process_args.append([recording_folder, dataset_folder, partition == 'train', manifest])
+
+    # Drop recordings that moved partition or no longer exist
+    for out_folder in experiment_path.glob('*/recording-*'):
+        if out_folder not in out_folders and out_folder.is_symlink():
+            out_folder.unlink()
+    print('Build %i of %i recordings' % (len(process_args), len(recording_folders)))
+
+    # Split every recording into frame chunks, which are merged once all of them are built
+    chunk_size = config['build'].get('chunk_size', 256)
+    tasks = []
+    chunks = {}
+    for recording_folder, out_folder, do_perturb, manifest in process_args:
+        # Build every sidecar cache the chunks read here, so workers only ever load them
+        n_frames = len(derp.recording.TopicReader(recording_folder, 'camera'))
+        derp.recording.load_columns(recording_folder, 'quality')
+        derp.recording.load_car_actions(recording_folder)
+        n_chunks = 0
+        for first in range(0, n_frames, chunk_size):
+            last = min(first + chunk_size, n_frames)
+            tasks.append([config, recording_folder, out_folder, do_perturb, first, last])
+            n_chunks += 1
+        chunks[recording_folder] = (out_folder, manifest, n_chunks, [])
+        if not n_chunks:
+            finish_recording(config, recording_folder, *chunks[recording_folder])
+    with multiprocessing.Pool(count) as pool:
+        for recording_folder, first, rows in pool.imap_unordered(build_chunk_fn, tasks):
+            chunks[recording_folder][3].append((first, rows))
+            if len(chunks[recording_folder][3]) == chunks[recording_folder][2]:
+                finish_recording(config, recording_folder, *chunks[recording_folder])
+
+
+def prune_datasets():
+    """
+    Remove every shared dataset folder that no experiment links to any more, such as the builds
+    of recordings or configs that have since changed
+    """
+    linked = {out_folder.resolve() for out_folder in derp.util.MODEL_ROOT.glob('*/*/recording-*')
+              if out_folder.is_symlink()}
+    n_pruned = 0
+    for dataset_folder in sorted(derp.util.DATASET_ROOT.glob('*')):
+        if dataset_folder.resolve() not in linked:
+            shutil.rmtree(str(dataset_folder))
+            n_pruned += 1
+    print('Pruned %i unused datasets' % n_pruned)
 
 
 def train(config, experiment_path, gpu):
@@ -103,16 +264,21 @@ def train(config, experiment_path, gpu):
     scheduler_fn = torch.optim.lr_scheduler.ReduceLROnPlateau
     dim_in = np.array([config['thumb'][x] for x in ['depth', 'height', 'width']])
 
-    # Prepare transforms
-    transformer = derp.model.compose_transforms(config['train']['transforms'])
+    # Prepare transforms, augmentations run on whole training batches after collation
+    transformer = derp.model.compose_transforms([])
+    augment = derp.model.compose_batch_transforms(config['train']['transforms']).to(device)
     train_fetcher = Fetcher(experiment_path / 'train', transformer, config['predict'])
     assert len(train_fetcher)
     test_fetcher = Fetcher(experiment_path / 'test', transformer, config['predict'])
     assert len(test_fetcher)
-    train_loader = DataLoader(
-        train_fetcher, config['train']['batch_size'], shuffle=True, num_workers=3,
+    # Small datasets are held in memory as tensors instead of being read by worker processes
+    memory_budget = config['train'].get('memory_budget', 0) * 2 ** 20
+    train_loader = make_loader(
+        train_fetcher, config['train']['batch_size'], shuffle=True, memory_budget=memory_budget,
+    )
+    test_loader = make_loader(
+        test_fetcher, config['train']['batch_size'], memory_budget=memory_budget,
     )
-    test_loader = DataLoader(test_fetcher, config['train']['batch_size'], num_workers=3)
     print('Train Loader: %6i' % len(train_loader.dataset))
     print('Test  Loader: %6i' % len(test_loader.dataset))
     np.random.seed(config['seed'])
@@ -126,7 +292,8 @@ def train(config, experiment_path, gpu):
     print('initial loss: %.6f' % loss_threshold)
     for epoch in range(config['train']['epochs']):
         start_time = time.time()
-        train_loss = derp.model.train_epoch(device, model, optimizer, criterion, train_loader)
+        train_loss = derp.model.train_epoch(device, model, optimizer, criterion, train_loader,
+                                                augment)
         test_loss = derp.model.test_epoch(device, model, criterion, test_loader)
         scheduler.step(test_loss)
         note = ''
@@ -137,6 +304,46 @@ def train(config, experiment_path, gpu):
         duration = time.time() - start_time
         print('Epoch %5i %.6f %.6f %.1fs %s' % (epoch, train_loss, test_loss, duration, note))
 
+    # Export the best model with the car's fixed input shapes for the onnx backend
+    model = derp.inference.load_model(experiment_path / 'model.pt', 'cpu')
+    derp.inference.export_onnx(model, config['thumb'], n_status, experiment_path / 'model.onnx')
+    print('exported %s' % (experiment_path / 'model.onnx'))
+    if config['train'].get('quantize', 'none') != 'none':
+        quantize(config, experiment_path, model, criterion, train_loader, test_loader, augment)
+
+
+def quantize(config, experiment_path, model, criterion, train_loader, test_loader, augment):
+    """
+    Write an int8 model-int8.ts, either calibrated directly or fine tuned with fake
+    quantization first, and print test loss and CPU latency of each model side by side.
+    """
+    cpu = torch.device('cpu')
+    backend = config['train'].get('quantize_backend', 'qnnpack')
+    n_batches = config['train'].get('calibration_batches', 16)
+    candidates = [('float32', model.cpu().eval())]
+    candidates.append(('int8', derp.model.quantize_static(model, test_loader, n_batches, backend)))
+    if config['train']['quantize'] == 'qat':
+        qat_model = derp.model.prepare_qat(model, backend)
+        optimizer = torch.optim.SGD(qat_model.parameters(), config['train']['learning_rate'] * 0.1)
+        for epoch in range(config['train'].get('qat_epochs', 4)):
+            train_loss = derp.model.train_epoch(cpu, qat_model, optimizer, criterion, train_loader,
+                                                augment.to(cpu))
+            print('QAT   %5i %.6f' % (epoch, train_loss))
+        candidates.append(('int8-qat', derp.model.convert_qat(qat_model)))
+    derp.inference.save_int8(candidates[-1][1], config['thumb'], len(config['status']),
+                             experiment_path / 'model-int8.ts')
+
+    thumbs = [test_loader.dataset.load_thumb(i) for i in range(min(200, len(test_loader.dataset)))]
+    status = np.zeros(len(config['status']), dtype=np.float32)
+    print('%-10s %10s %8s %8s %8s' % ('model', 'test loss', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name, candidate in candidates:
+        test_loss = derp.model.test_epoch(cpu, candidate, criterion, test_loader)
+        engine = derp.inference.InferenceEngine(candidate, config['thumb'], len(status), cpu)
+        for thumb in thumbs:
+            engine.predict(thumb, status)
+        print('%-10s %10.6f %8.3f %8.3f %8.3f' % (name, test_loss, *engine.latency_percentiles()))
+    print('saved %s as %s' % (candidates[-1][0], experiment_path / 'model-int8.ts'))
+
 
 def main():
     """
@@ -147,6 +354,8 @@ def main():
     parser.add_argument('brain', type=Path, help='Controller we wish to train')
     parser.add_argument('--gpu', type=str, default='0', help='GPU to use')
     parser.add_argument('--count', type=int, default=4, help='parallel processes to build with')
+    parser.add_argument('--prune', action='store_true',
+                        help='remove built datasets that no experiment links to after building')
 
     args = parser.parse_args()
 
@@ -155,6 +364,8 @@ def main():
     experiment_path.mkdir(parents=True, exist_ok=True)
 
     build(config, experiment_path, args.count)
+    if args.prune:
+        prune_datasets()
     train(config, experiment_path, args.gpu)
 
 
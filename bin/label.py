@@ -1,18 +1,21 @@
 #!/usr/bin/env python3
 """OpenCV-based frame viewer that replays recordings and assign time-based labels"""
 import argparse
+import functools
 from pathlib import Path
 import time
 import cv2
 import numpy as np
+from derp.framecache import FrameCache
+import derp.recording
 import derp.util
 
 
 class Labeler:
     """OpenCV-based frame viewer that replays recordings and assign time-based labels"""
 
-    def __init__(self, folder, scale=1, bhh=40):
-        """Load the topics and existing labels from the folder, scaling up the frame"""
+    def __init__(self, folder, scale=1, bhh=40, cache_bytes=536870912):
+        """Open the camera index and cached columns of the folder, decoding frames on demand"""
         self.folder = folder
         self.scale = scale
         self.bhh = bhh
@@ -22,9 +25,19 @@ class Labeler:
         self.window_name = "Labeler %s" % self.folder
         self.config = derp.util.load_config(self.config_path)
         self.quality_colors = [(0, 0, 255), (0, 128, 255), (0, 255, 0)]
-        self.topics = derp.util.load_topics(folder)
+        self.camera = derp.recording.TopicReader(folder, "camera")
+        # Frames shown smaller than recorded are decoded at a reduced scale to begin with
+        camera_config = self.config["camera"]
+        self.reduction = derp.util.scale_reduction(scale)
+        self.frame_size = (int(round(camera_config["width"] * scale)),
+                           int(round(camera_config["height"] * scale)))
         self.frame_id = 0
-        self.n_frames = len(self.topics["camera"])
+        self.direction = 1
+        self.n_frames = len(self.camera)
+        # Decoded frames are cached and prefetched where playback or the number keys go next
+        self.jump_targets = [min(self.n_frames - 1, int(self.n_frames * i / 4)) for i in range(5)]
+        load = functools.partial(load_frame, self.camera, self.reduction, self.frame_size)
+        self.frames = FrameCache(load, self.n_frames, cache_bytes, targets=self.jump_targets)
         self.seek(self.frame_id)
         self.f_h = self.frame.shape[0]
         self.f_w = self.frame.shape[1]
@@ -35,38 +48,34 @@ class Labeler:
         self.paused = True
         self.show = False
 
-        # Prepare labels
-        self.autonomous_bar = np.ones((self.f_w, 3), dtype=np.uint8) * (255, 255, 255)
-        self.quality_bar = np.ones((self.f_w, 3), dtype=np.uint8) * (128, 128, 128)
-        if "quality" in self.topics and len(self.topics["quality"]) >= self.n_frames:
-            self.qualities = [str(msg.quality) for msg in self.topics["quality"]]
+        # Prepare labels as one enum value per frame, the bar shows the worst of each column
+        self.columns = {topic: derp.recording.load_columns(folder, topic)
+                        for topic in ("action", "controller", "quality")}
+        self.quality_values = dict(derp.util.TOPICS["quality"].QualityEnum.schema.enumerants)
+        self.quality_names = {value: name for name, value in self.quality_values.items()}
+        if len(self.columns["quality"]["quality"]) >= self.n_frames:
+            self.qualities = np.array(self.columns["quality"]["quality"][: self.n_frames])
         else:
-            self.qualities = ["junk" for _ in range(self.n_frames)]
-        for i, quality in enumerate(self.qualities):
-            self.update_quality(i, i, quality)
+            self.qualities = np.full(self.n_frames, self.quality_values["junk"], dtype=np.int8)
+        self.draw_quality_bar()
 
-        # Prepare state messages
-        self.camera_times = [msg.publishNS for msg in self.topics["camera"]]
-        self.camera_autos = []
-        auto = False
-        for timestamp, topic, msg in derp.util.replay(self.topics):
-            if topic == 'controller':
-                auto = msg.isAutonomous
-            elif topic == 'camera':
-                self.camera_autos.append(auto)
+        # Prepare state messages, the bars are drawn from per pixel column aggregates
+        self.camera_times = self.camera.times
+        controls = self.columns["controller"]
+        self.camera_autos = derp.util.extract_latest(self.camera_times, controls["publishNS"],
+                                                     controls["isAutonomous"])
 
-        actions = derp.util.extract_car_actions(self.topics)
+        actions = derp.util.combine_car_actions(self.columns["action"], controls)
         self.camera_speeds = derp.util.extract_latest(self.camera_times,
                                                       actions[:, 0], actions[:, 1])
         self.camera_steers = derp.util.extract_latest(self.camera_times,
                                                       actions[:, 0], actions[:, 2])
-        window_Xs = np.linspace(self.camera_times[0], self.camera_times[-1], self.f_w)
-        self.window_speeds = np.array(np.interp(window_Xs, self.camera_times, self.camera_speeds)
-                                      * -self.bhh, dtype=np.int)
-        self.window_steers = np.array(np.interp(window_Xs, self.camera_times, self.camera_steers)
-                                      * -self.bhh, dtype=np.int)
-        self.autonomous_bar *= np.array(np.interp(window_Xs, self.camera_times,
-                                                  self.camera_autos), dtype=np.uint8)[:, None]
+        self.window_speeds = (derp.util.column_aggregate(self.camera_speeds, self.f_w)
+                              * -self.bhh).astype(int)
+        self.window_steers = (derp.util.column_aggregate(self.camera_steers, self.f_w)
+                              * -self.bhh).astype(int)
+        autos = derp.util.column_aggregate(self.camera_autos.astype(np.uint8), self.f_w, np.maximum)
+        self.autonomous_bar = np.repeat(autos[:, None] * np.uint8(255), 3, axis=1)
         self.window_steers[self.window_steers > self.bhh] = self.bhh
         self.window_steers[self.window_steers < -self.bhh] = -self.bhh
 
@@ -94,13 +103,15 @@ class Labeler:
         if quality is None:
             return False
         first_index, last_index = min(first_index, last_index), max(first_index, last_index)
-        for index in range(first_index, last_index + 1):
-            self.qualities[index] = quality
-        beg_pos = self.frame_pos(first_index)
-        end_pos = self.frame_pos(last_index + (self.n_frames < len(self.quality_bar)))
-        self.quality_bar[beg_pos : end_pos + 1] = self.bar_color(quality)
+        self.qualities[first_index : last_index + 1] = self.quality_values[quality]
+        self.draw_quality_bar()
         return True
 
+    def draw_quality_bar(self):
+        """Color each pixel column of the quality bar by the worst quality of its frames"""
+        worst = derp.util.column_aggregate(self.qualities, self.f_w, np.minimum)
+        self.quality_bar = np.array(self.quality_colors, dtype=np.uint8)[worst]
+
     def seek(self, frame_id=None):
         """Update the current frame to the given frame_id, otherwise advances by 1 frame"""
         if frame_id is None:
@@ -112,13 +123,10 @@ class Labeler:
             frame_id = self.n_frames - 1
             self.paused = True
         self.update_quality(self.frame_id, frame_id, self.quality)
-        self.frame = cv2.resize(
-            derp.util.decode_jpg(self.topics["camera"][frame_id].jpg),
-            None,
-            fx=self.scale,
-            fy=self.scale,
-            interpolation=cv2.INTER_AREA,
-        )
+        if frame_id != self.frame_id:
+            self.direction = 1 if frame_id > self.frame_id else -1
+        self.frame = self.frames.get(frame_id)
+        self.frames.prefetch(frame_id, self.direction)
         self.frame_id = frame_id
         return True
 
@@ -163,11 +171,15 @@ class Labeler:
             for quality_i, quality in enumerate(self.qualities):
                 msg = derp.util.TOPICS["quality"].new_message(
                     createNS=derp.util.get_timestamp(),
-                    publishNS=self.topics["camera"][quality_i].publishNS - 1,
+                    publishNS=int(self.camera_times[quality_i]) - 1,
                     writeNS=derp.util.get_timestamp(),
-                    quality=quality,
+                    quality=self.quality_names[int(quality)],
                 )
                 msg.write(quality_fd)
+        # A repacked quality topic is superseded, the readers would otherwise pick either file
+        packed_path = derp.util.packed_topic_path(self.folder, "quality")
+        if packed_path.exists():
+            packed_path.unlink()
         print("Saved quality labels in", self.folder)
         if self.config_changed:
             derp.util.dump_config(self.config, self.config_path)
@@ -207,7 +219,7 @@ class Labeler:
             self.config["camera"]["pitch"] += 0.1  # page down
             self.config_changed = True
         elif ord("1") <= key <= ord("5"):
-            self.seek(int(self.n_frames * (key - ord("0") - 1) / 4))
+            self.seek(self.jump_targets[key - ord("1")])
         elif key != 255:
             print("Unknown key press: [%s]" % key)
         self.show = True
@@ -215,7 +227,7 @@ class Labeler:
 
     def frame_pos(self, frame_id):
         """Position of current camera frame on the horizontal status bars"""
-        return min(self.f_w - 1, int(frame_id / self.n_frames * self.f_w))
+        return min(self.f_w - 1, frame_id * self.f_w // self.n_frames)
 
     def run(self):
         """Run the labeling program in a forever loop until the user quits"""
@@ -229,6 +241,16 @@ class Labeler:
             if not self.handle_keyboard_input():
                 break
             time.sleep(0.01)
+        self.frames.close()
+
+
+def load_frame(camera, reduction, frame_size, frame_id):
+    """Decode and scale a camera frame for display, kept apart so the cache holds no labeler"""
+    return cv2.resize(
+        derp.util.decode_jpg(camera[frame_id].jpg, reduction),
+        frame_size,
+        interpolation=cv2.INTER_AREA,
+    )
 
 
 def main():
@@ -257,13 +279,14 @@ To change the quality label of this frame
     parser = argparse.ArgumentParser()
     parser.add_argument("paths", type=Path, nargs="*", metavar="N", help="recording path location")
     parser.add_argument("--scale", type=float, default=1.0, help="frame rescale ratio")
+    parser.add_argument("--cache", type=int, default=512, help="MB of decoded frames to keep")
     args = parser.parse_args()
     if not args.paths:
         recordings = (derp.util.DERP_ROOT / "recordings").glob("recording-*")
-        args.paths = [r for r in recordings if not (r / "quality.bin").exists()]
+        args.paths = [r for r in recordings if not derp.util.topic_exists(r, "quality")]
     for path in args.paths:
         print("Labeling", path)
-        labeler = Labeler(folder=path, scale=args.scale)
+        labeler = Labeler(folder=path, scale=args.scale, cache_bytes=args.cache << 20)
         labeler.run()
 
 
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Repack archived recordings losslessly to save disk and copying time. Every scalar topic is
+rewritten as zstd-compressed chunks of capnp packed messages in <topic>.zst, which the
+readers open just like the original <topic>.bin. Camera jpgs do not compress any further, so
+camera.bin is only cut to its complete messages and given its seek index with --camera.
+"""
+import argparse
+from multiprocessing import Pool
+from pathlib import Path
+import time
+import numpy as np
+import derp.recording
+import derp.util
+
+
+def repack_topic(folder, topic, chunk_size, level):
+    """ Write a topic's packed file and remove the regular one once it reads back the same """
+    reader = derp.recording.TopicReader(folder, topic)
+    n_messages = derp.util.write_packed_topic(folder, topic, reader, chunk_size, level)
+    data = derp.util.read_packed_topic(folder, topic)
+    times = [msg.publishNS for msg in derp.util.TOPICS[topic].read_multiple_bytes(data)]
+    reader.close()
+    if n_messages != len(reader) or not np.array_equal(times, reader.times):
+        derp.util.packed_topic_path(folder, topic).unlink()
+        raise RuntimeError("%s %s did not read back intact" % (folder.name, topic))
+    for path in (folder / ("%s.bin" % topic),
+                 derp.recording.segments_path(folder, topic),
+                 derp.recording.index_path(folder, topic),
+                 derp.recording.columns_path(folder, topic)):
+        if path.exists():
+            path.unlink()
+
+
+def repack(args):
+    """ Repack one recording, returning its topic bytes before and after """
+    folder, chunk_size, level, camera = args
+    before = sum(derp.util.topic_path(folder, t).stat().st_size
+                 for t in derp.util.TOPICS if derp.util.topic_exists(folder, t))
+    for topic in derp.util.TOPICS:
+        if topic == "camera" or not (folder / ("%s.bin" % topic)).exists():
+            continue
+        repack_topic(folder, topic, chunk_size, level)
+    if camera and (folder / "camera.bin").exists():
+        derp.recording.truncate_torn(folder, "camera")
+        derp.recording.TopicReader(folder, "camera").close()
+    after = sum(derp.util.topic_path(folder, t).stat().st_size
+                for t in derp.util.TOPICS if derp.util.topic_exists(folder, t))
+    return folder, before, after
+
+
+def main():
+    """ Repack every recording in parallel and report the space saved """
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("paths", type=Path, nargs='+', help="locations of recordings")
+    parser.add_argument("--chunk", type=int, default=4096, help="messages per zstd chunk")
+    parser.add_argument("--level", type=int, default=10, help="zstd compression level")
+    parser.add_argument("--camera", action='store_true',
+                        help="also cut camera.bin to complete messages and index it for seeking")
+    parser.add_argument("--count", type=int, default=4, help="parallel processes to repack with")
+    args = parser.parse_args()
+    try:
+        derp.util.require_zstandard()
+    except RuntimeError as error:
+        parser.error(str(error))
+
+    tasks = [(path, args.chunk, args.level, args.camera) for path in args.paths]
+    start_time = time.time()
+    total_before, total_after = 0, 0
+    with Pool(args.count) as pool:
+        for folder, before, after in pool.imap_unordered(repack, tasks):
+            total_before += before
+            total_after += after
+            print("%s %12i -> %12i bytes" % (folder.name, before, after))
+    print("%i recordings, %i -> %i bytes in %.1fs" %
+          (len(tasks), total_before, total_after, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    main()
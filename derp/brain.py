@@ -1,8 +1,9 @@
 """
 The root class of any object that manipulate's the car state based on some heuristic.
 """
+import cv2
 import numpy as np
-import torch
+from derp.framering import open_ring
 from derp.part import Part
 import derp.util
 
@@ -15,62 +16,102 @@ class Brain(Part):
     def __init__(self, config, init_pubsub=True):
         """Preset some common constructor parameters"""
         super(Brain, self).__init__(config, 'brain', ['camera', 'joystick', 'imu'], init_pubsub)
-        self.device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
         self.speed = 0
         self.steer = 0
 
-    def predict(self):
+    def predict(self, topic):
         return True
 
     def run(self):
-        """ Publish an action at every camera timestamp """
+        """ Publish an action at every camera timestamp, whether a jpg or a shared frame """
         topic = self.subscribe()
-        if topic == 'camera' and self.predict():
+        if topic in ('camera', 'frame') and self.predict(topic):
             self.publish('action', isManual=False, speed=float(self.speed), steer=float(self.steer))
         if topic == 'controller' and self._messages[topic].exit:
             return False
         return True
 
-    def batch_vector(self, vector):
-        numpy_batch = np.reshape(vector, [1, len(vector)])
-        torch_batch = torch.from_numpy(numpy_batch).float().to(self.device)
-        return torch_batch
-
-    def batch_tensor(self, tensor):
-        numpy_batch = np.reshape(tensor, [1] * (4 - len(tensor.shape)) + list(tensor.shape))
-        torch_batch = torch.from_numpy(numpy_batch.transpose((0, 3, 1, 2))).float().to(self.device)
-        return torch_batch
-
-    def unbatch(self, batch):
-        if torch.cuda.is_available():
-            out = batch.data.cpu().numpy()
-        else:
-            out = batch.data.numpy()
-        return out
-
 
 class Clone(Brain):
     def __init__(self, config):
         super(Clone, self).__init__(config, False)
-        model_path = derp.util.MODEL_ROOT / self._config['name'] / 'model.pt'
-        self.model = torch.load(model_path).to(self.device) if model_path.exists() else None
+        self.engine = self.load_engine()
+        self.report_every = self._config.get('latency_report_every', 300)
         self.bbox = derp.util.get_patch_bbox(self._config['thumb'], self._global_config['camera'])
         self.size = (self._config['thumb']['width'], self._config['thumb']['height'])
+        self.ring = None
+        self.reduction, self.decode_bbox, self.decode_buffer = self.prepare_decode()
         self.init_pubsub()
 
-    def predict(self):
-        if self.model is None:
+    def load_engine(self):
+        """
+        The torch backend runs the pickled model.pt, or the TorchScript model-int8.ts at int8
+        precision. The onnx backend runs model.onnx through onnxruntime without torch.
+        """
+        model_folder = derp.util.MODEL_ROOT / self._config['name']
+        n_status = len(self._config['status'])
+        if self._config.get('backend', 'torch') == 'onnx':
+            if not (model_folder / 'model.onnx').exists():
+                return None
+            from derp.runtime import OnnxEngine
+            return OnnxEngine(model_folder / 'model.onnx', n_status, self._config.get('threads', 1))
+        from derp.inference import load_engine, load_int8_engine
+        if self._config.get('precision') == 'int8':
+            if not (model_folder / 'model-int8.ts').exists():
+                return None
+            backend = self._config['train'].get('quantize_backend', 'qnnpack')
+            return load_int8_engine(model_folder / 'model-int8.ts', self._config['thumb'],
+                                    n_status, backend)
+        if not (model_folder / 'model.pt').exists():
+            return None
+        return load_engine(model_folder / 'model.pt', self._config['thumb'], n_status,
+                           self._config.get('compile', True))
+
+    def prepare_decode(self):
+        """
+        Decode jpgs into one reused buffer, at the reduced scale the model was built with if
+        the build decoded frames reduced as well, and find the thumb's bbox in that frame
+        """
+        camera_config = self._global_config['camera']
+        reduction = 1
+        if self.bbox is not None and self._config['build'].get('reduce'):
+            reduction = derp.util.jpg_reduction(self.bbox, self.size)
+        decode_config = derp.util.reduce_config(camera_config, reduction)
+        decode_bbox = derp.util.get_patch_bbox(self._config['thumb'], decode_config)
+        if decode_bbox is None:
+            reduction, decode_config, decode_bbox = 1, camera_config, self.bbox
+        shape = (decode_config['height'], decode_config['width'], camera_config['depth'])
+        return reduction, decode_bbox, np.empty(shape, dtype=np.uint8)
+
+    def predict(self, topic):
+        if self.engine is None:
             return False
         if self.bbox is None:
             return False
-        frame = derp.util.decode_jpg(self._messages['camera'].jpg)
-        patch = derp.util.crop(frame, self.bbox)
-        thumb = derp.util.resize(patch, self.size) / 255
-        status_batch = self.batch_vector([])
-        thumb_batch = self.batch_tensor(thumb)
-
-        prediction_batch = self.model(thumb_batch, status_batch)
-        predictions = self.unbatch(prediction_batch)[0]
+        if topic == 'frame':
+            # Read the pixels in place and make sure the camera did not overwrite them meanwhile
+            sequence = self._messages['frame'].sequence
+            if self.ring is None:
+                self.ring = open_ring(self._global_config['camera'])
+            frame = None if self.ring is None else self.ring.frame(sequence)
+            if frame is None:
+                return False
+            if self.reduction > 1:
+                # Shrink the frame like a reduced decode so both transports give the same thumb
+                size = (self.decode_buffer.shape[1], self.decode_buffer.shape[0])
+                frame = cv2.resize(frame, size, dst=self.decode_buffer,
+                                   interpolation=cv2.INTER_AREA)
+            thumb = derp.util.resize(derp.util.crop(frame, self.decode_bbox), self.size)
+            if not self.ring.is_current(sequence):
+                return False
+        else:
+            frame = derp.util.decode_jpg(self._messages['camera'].jpg, self.reduction,
+                                         self.decode_buffer)
+            thumb = derp.util.resize(derp.util.crop(frame, self.decode_bbox), self.size)
+        predictions = self.engine.predict(thumb)
+        if self.report_every and self.engine.n_predictions % self.report_every == 0:
+            self._logger.info('predict latency ms p50 %.2f p90 %.2f p99 %.2f'
+                              % tuple(self.engine.latency_percentiles()))
 
         self.speed = self._messages['controller'].speedOffset
         for prediction, config in zip(predictions, self._config['predict']):
@@ -1,6 +1,10 @@
 """The Camera manages the camera interface and sends camera messages."""
 import cv2
+import queue
+import threading
 import time
+import weakref
+from derp.framering import create_ring
 from derp.part import Part
 import derp.util
 
@@ -14,12 +18,48 @@ class Camera(Part):
         self._cap = None
         self.size = (self._config["width"], self._config["height"])
         self._frame = None
+        # Raw frames go through shared memory and only their sequence numbers are published
+        self._ring = create_ring(self._config) if self._config.get("transport") == "shm" else None
+        self._sequence = 0
+        # Frames wait in a bounded queue for the encoder threads, the oldest is dropped when full
+        self._queue = queue.Queue(self._config.get("encode_queue", 4))
+        self._publish_lock = threading.Lock()
+        # Encoded frames are published in capture order, each waiting for the ones before it
+        self._publish_turn = threading.Condition(self._publish_lock)
+        self._encode_sequence = 0
+        self._next_publish = 1
+        self._finished = set()
+        self._encoders = []
+        if self._ring is None:
+            for _ in range(self._config.get("encode_threads", 2)):
+                encoder = threading.Thread(
+                    target=encode_loop, args=(weakref.ref(self), self._queue), daemon=True
+                )
+                encoder.start()
+                self._encoders.append(encoder)
         self.__connect()
 
     def __del__(self):
+        # Drop the waiting frames so every encoder's None fits without evicting another one
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            with self._publish_turn:
+                self.__finish(item[2])
+        # The last encoder to let go of the camera may be the one running this
+        encoders = [encoder for encoder in self._encoders
+                    if encoder is not threading.current_thread()]
+        for _ in encoders:
+            self._queue.put(None)
+        for encoder in encoders:
+            encoder.join()
         super(Camera, self).__del__()
         if self._cap is not None:
             self._cap.release()
+        if self._ring is not None:
+            self._ring.path.unlink()
 
     def __connect(self):
         if self._cap is not None:
@@ -68,17 +108,86 @@ class Camera(Part):
 
     def read(self):
         """ Read the camera image if possible, and if so update the timestamp we received data """
-        ret, self._frame = self._cap.read()
+        if self._ring is None:
+            ret, self._frame = self._cap.read()
+            self._timestamp = derp.util.get_timestamp()
+            return ret
+        self._sequence += 1
+        slot = self._ring.claim(self._sequence)
+        ret, self._frame = self._cap.read(slot)
         self._timestamp = derp.util.get_timestamp()
+        if ret and self._frame is not slot:
+            slot[...] = self._frame
+        if ret:
+            self._ring.commit(self._sequence, self._timestamp)
         return ret
 
+    def __enqueue(self, item):
+        """ Queue a frame for encoding, dropping the oldest waiting frame if the queue is full """
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                dropped = self._queue.get_nowait()
+            except queue.Empty:
+                continue
+            self._dropped["camera"] += 1
+            with self._publish_turn:
+                self.__finish(dropped[2])
+
+    def __finish(self, sequence):
+        """ Mark a frame published or dropped, passing the turn on past every finished one """
+        self._finished.add(sequence)
+        while self._next_publish in self._finished:
+            self._finished.remove(self._next_publish)
+            self._next_publish += 1
+        self._publish_turn.notify_all()
+
+    def encode(self, frame, create_ns, sequence):
+        """ Encode a frame captured at create_ns and publish it once every earlier one is out """
+        jpg = derp.util.encode_jpg(frame, self._config["quality"])
+        with self._publish_turn:
+            while self._next_publish != sequence:
+                self._publish_turn.wait()
+            self.publish("camera", create_ns, index=self._config["index"], jpg=jpg)
+            self.__finish(sequence)
+
     def run(self):
-        """Get and publish the camera frame"""
+        """Get and publish the camera frame, or just its sequence number in shared memory"""
         if not self.read():
             return False
-        self.publish(
-            "camera",
-            index=self._config["index"],
-            jpg=derp.util.encode_jpg(self._frame, self._config["quality"]),
-        )
+        if self._ring is not None:
+            self.publish("frame", index=self._config["index"], sequence=self._sequence)
+            return True
+        if not self._encoders:
+            self.publish(
+                "camera",
+                index=self._config["index"],
+                jpg=derp.util.encode_jpg(self._frame, self._config["quality"]),
+            )
+            return True
+        self._encode_sequence += 1
+        self.__enqueue((self._frame, self._timestamp, self._encode_sequence))
+        if self._dropped and self._timestamp - self._metric_ns >= self._metric_interval_ns:
+            with self._publish_lock:
+                self.publish_metrics()
         return True
+
+
+def encode_loop(camera_ref, frame_queue):
+    """
+    Encode queued frames until a None arrives, cv2 releases the GIL while it encodes. Only a
+    weak reference to the camera is held so it is still deleted and cleaned up as usual.
+    """
+    while True:
+        item = frame_queue.get()
+        camera = camera_ref()
+        if item is None or camera is None:
+            return
+        camera.encode(*item)
+        del camera
+        if camera_ref() is None:
+            return
@@ -1,10 +1,12 @@
 """
 Fetcher is an image-loader for use with training.
 """
+import bisect
 import csv
 import numpy as np
 import PIL.Image
 import torch.utils.data
+import torchvision.transforms
 import derp.util
 
 
@@ -20,6 +22,7 @@ class Fetcher(torch.utils.data.Dataset):
         Since we use a feed dict, each state variable is stored as a mapping from its
         string name to its value. It is then the responsibility of the data loader or
         training script to properly convert to an array that can be optimized against.
+        Recordings built in the packed format have their thumbs memory-mapped instead.
         """
 
         # Store constructor arguments
@@ -28,8 +31,9 @@ class Fetcher(torch.utils.data.Dataset):
         self.transforms = transforms
         self.predict_config = predict_config
 
-        # Pepare variables to store each item
-        self.paths = []
+        # Pepare variables to store each item, thumbs are either image paths or packed arrays
+        self.sources = []
+        self.ends = []
         self.status = []
         self.predict = []
 
@@ -37,28 +41,84 @@ class Fetcher(torch.utils.data.Dataset):
         # Each video has a certain fixed number of state variables which we will encode as a dict
         for recording_name in sorted(self.root.glob("recording-*")):
             recording_path = self.root / recording_name
-            status_path = recording_path / "status.csv"
-            assert status_path.exists()
-            predict_path = recording_path / "predict.csv"
-            assert predict_path.exists()
-
-            with open(str(status_path)) as status_fd, open(str(predict_path)) as predict_fd:
-                sp_reader, pp_reader = csv.reader(status_fd), csv.reader(predict_fd)
-                for status_row, predict_row in zip(sp_reader, pp_reader):
-                    assert status_row[0] == predict_row[0]
-                    image_path = recording_path / status_row[0]
-                    status = np.array([float(x) for x in status_row[1:]], dtype=np.float32)
-                    predict = np.array([float(x) for x in predict_row[1:]], dtype=np.float32)
-                    if not status:
-                        status = np.zeros(1, dtype=np.float32)
-                    self.paths.append(image_path)
-                    self.status.append(status)
-                    self.predict.append(predict)
+            if (recording_path / "thumbs.npy").exists():
+                self.load_packed(recording_path)
+            else:
+                self.load_csv(recording_path)
+            self.ends.append(len(self.status))
+
+    def load_csv(self, recording_path):
+        """ Read the status and predict csvs of a recording whose thumbs are image files """
+        status_path = recording_path / "status.csv"
+        assert status_path.exists()
+        predict_path = recording_path / "predict.csv"
+        assert predict_path.exists()
+
+        paths = []
+        with open(str(status_path)) as status_fd, open(str(predict_path)) as predict_fd:
+            sp_reader, pp_reader = csv.reader(status_fd), csv.reader(predict_fd)
+            for status_row, predict_row in zip(sp_reader, pp_reader):
+                assert status_row[0] == predict_row[0]
+                image_path = recording_path / status_row[0]
+                status = np.array([float(x) for x in status_row[1:]], dtype=np.float32)
+                predict = np.array([float(x) for x in predict_row[1:]], dtype=np.float32)
+                if not status.size:
+                    status = np.zeros(1, dtype=np.float32)
+                paths.append(image_path)
+                self.status.append(status)
+                self.predict.append(predict)
+        self.sources.append(paths)
+
+    def load_packed(self, recording_path):
+        """ Memory-map the thumbs of a packed recording and read its status and predictions """
+        thumbs = np.load(str(recording_path / "thumbs.npy"), mmap_mode="r")
+        status = np.load(str(recording_path / "status.npy"))
+        predict = np.load(str(recording_path / "predict.npy"))
+        assert len(thumbs) == len(status) == len(predict)
+        if not status.shape[1]:
+            status = np.zeros((len(status), 1), dtype=np.float32)
+        self.sources.append(thumbs)
+        self.status.extend(status)
+        self.predict.extend(predict)
+
+    def load_thumb(self, index):
+        """ The BGR thumb of the given index from its image file or packed array """
+        source_i = bisect.bisect_right(self.ends, index)
+        source = self.sources[source_i]
+        source_index = index - self.ends[source_i] + len(source)
+        if isinstance(source, np.ndarray):
+            return np.array(source[source_index])
+        return derp.util.load_image(source[source_index])
+
+    def nbytes(self):
+        """ Bytes needed to hold every thumb of the dataset in memory as uint8 """
+        if not len(self):
+            return 0
+        return len(self) * self.load_thumb(0).nbytes
+
+    def load_tensors(self):
+        """
+        Every thumb as one preallocated NCHW uint8 tensor, along with the stacked status and
+        predict tensors. Per-item transforms are not applied.
+        """
+        height, width, depth = self.load_thumb(0).shape
+        thumbs = torch.empty((len(self), depth, height, width), dtype=torch.uint8)
+        start = 0
+        for source, end in zip(self.sources, self.ends):
+            if isinstance(source, np.ndarray):
+                thumbs.numpy()[start:end] = source.transpose(0, 3, 1, 2)
+            else:
+                for index in range(start, end):
+                    thumbs[index] = torch.from_numpy(self.load_thumb(index)).permute(2, 0, 1)
+            start = end
+        status = torch.from_numpy(np.stack(self.status))
+        predict = torch.from_numpy(np.stack(self.predict))
+        return thumbs, status, predict
 
     def __getitem__(self, index):
         """ Return the specified index. Apply transforms as specified """
 
-        thumb = PIL.Image.fromarray(derp.util.load_image(self.paths[index]))
+        thumb = PIL.Image.fromarray(self.load_thumb(index))
         status = self.status[index]
         predict = self.predict[index]
         if self.transforms is not None:
@@ -67,4 +127,55 @@ class Fetcher(torch.utils.data.Dataset):
 
     def __len__(self):
         """ Return the number of items our fetcher is responsible for """
-        return len(self.paths)
+        return len(self.status)
+
+
+def only_to_tensor(transforms):
+    """ Whether transforms do nothing but ToTensor, the one step TensorLoader does itself """
+    if isinstance(transforms, torchvision.transforms.Compose) and len(transforms.transforms) == 1:
+        transforms = transforms.transforms[0]
+    return isinstance(transforms, torchvision.transforms.ToTensor)
+
+
+class TensorLoader:
+    """
+    A single-process stand-in for DataLoader that holds a whole Fetcher in memory as tensors
+    and batches by indexing them, with no worker processes or per-item work.
+    """
+
+    def __init__(self, fetcher, batch_size, shuffle=False):
+        if not only_to_tensor(fetcher.transforms):
+            raise ValueError("TensorLoader would skip the fetcher's transforms %s"
+                             % fetcher.transforms)
+        self.dataset = fetcher
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.thumbs, self.status, self.predict = fetcher.load_tensors()
+
+    def __iter__(self):
+        """ Yield float thumbs in [0, 1] like ToTensor along with their status and predict """
+        if self.shuffle:
+            order = torch.randperm(len(self.thumbs))
+        else:
+            order = torch.arange(len(self.thumbs))
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            thumbs = self.thumbs.index_select(0, indices).float().div_(255)
+            status = self.status.index_select(0, indices)
+            yield thumbs, status, self.predict.index_select(0, indices)
+
+    def __len__(self):
+        return (len(self.thumbs) + self.batch_size - 1) // self.batch_size
+
+
+def make_loader(fetcher, batch_size, shuffle=False, memory_budget=0, num_workers=3):
+    """
+    A TensorLoader if the fetcher's thumbs fit in memory_budget bytes and its transforms are a
+    bare ToTensor, else a DataLoader that applies the transforms to every item
+    """
+    if fetcher.nbytes() <= memory_budget:
+        if only_to_tensor(fetcher.transforms):
+            return TensorLoader(fetcher, batch_size, shuffle)
+        print("%s fits in memory but its transforms need a DataLoader" % fetcher.root)
+    return torch.utils.data.DataLoader(fetcher, batch_size, shuffle=shuffle,
+                                       num_workers=num_workers)
@@ -0,0 +1,123 @@
+"""
+An LRU cache of decoded frames under a memory budget. A background thread keeps it filled
+around a cursor, with fixed targets first, then frames ahead of the cursor in the direction it
+is moving and a few behind it, so stepping and jumping through a recording rarely decodes.
+"""
+import atexit
+import collections
+import threading
+import weakref
+
+# Caches still prefetching, stopped at exit since a thread decoding then would abort the process
+_OPEN_CACHES = weakref.WeakSet()
+
+
+class FrameCache:
+    """ Decoded frames by position, prefetched around the cursor from a background thread """
+
+    def __init__(self, load, n_frames, max_bytes=536870912, ahead=32, behind=8, targets=()):
+        """
+        Args:
+            load (callable): Decodes the frame at a position, called from both threads.
+            n_frames (int): Frames that can be loaded.
+            max_bytes (int): Memory kept for decoded frames before the least recent is evicted.
+            ahead (int): Frames prefetched in the direction the cursor moves.
+            behind (int): Frames prefetched the other way.
+            targets (list): Positions always kept ready, such as jump targets.
+        """
+        self._load = load
+        self.n_frames = n_frames
+        self._max_bytes = max_bytes
+        self._ahead = ahead
+        self._behind = behind
+        self._targets = [frame_id for frame_id in targets if 0 <= frame_id < n_frames]
+        self._frames = collections.OrderedDict()
+        self._n_bytes = 0
+        self._capacity = None
+        self._plan = []
+        self._plan_i = 0
+        self._stopped = False
+        self._changed = threading.Condition()
+        self.n_hits = 0
+        self.n_misses = 0
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+        _OPEN_CACHES.add(self)
+
+    def __contains__(self, frame_id):
+        with self._changed:
+            return frame_id in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def close(self):
+        """ Stop prefetching and wait for the thread to finish its frame """
+        with self._changed:
+            self._stopped = True
+            self._changed.notify()
+        self._thread.join()
+        _OPEN_CACHES.discard(self)
+
+    def get(self, frame_id):
+        """ The decoded frame, loaded right away if it has not been prefetched """
+        with self._changed:
+            frame = self._frames.get(frame_id)
+            if frame is not None:
+                self._frames.move_to_end(frame_id)
+                self.n_hits += 1
+                return frame
+            self.n_misses += 1
+        return self.__insert(frame_id, self._load(frame_id))
+
+    def prefetch(self, frame_id, direction=1):
+        """ Move the cursor, replacing whatever was left to prefetch around the old one """
+        step = -1 if direction < 0 else 1
+        plan = list(self._targets)
+        plan += [frame_id + step * i for i in range(1, self._ahead + 1)]
+        plan += [frame_id - step * i for i in range(1, self._behind + 1)]
+        plan = list(dict.fromkeys(i for i in plan if 0 <= i < self.n_frames and i != frame_id))
+        with self._changed:
+            # Never plan more than fits beside the current frame, or the plan evicts itself
+            if self._capacity is not None:
+                plan = plan[: max(0, self._capacity - 1)]
+            self._plan = plan
+            self._plan_i = 0
+            self._changed.notify()
+
+    def __insert(self, frame_id, frame):
+        """ Add a frame as the most recent one and evict the least recent ones over budget """
+        with self._changed:
+            if frame_id in self._frames:
+                self._frames.move_to_end(frame_id)
+                return self._frames[frame_id]
+            if self._capacity is None:
+                self._capacity = max(1, self._max_bytes // max(1, frame.nbytes))
+            self._frames[frame_id] = frame
+            self._n_bytes += frame.nbytes
+            while self._n_bytes > self._max_bytes and len(self._frames) > 1:
+                _, evicted = self._frames.popitem(last=False)
+                self._n_bytes -= evicted.nbytes
+            return frame
+
+    def __run(self):
+        """ Load the planned frames in order, keeping those already cached from eviction """
+        while True:
+            with self._changed:
+                while not self._stopped and self._plan_i >= len(self._plan):
+                    self._changed.wait()
+                if self._stopped:
+                    return
+                frame_id = self._plan[self._plan_i]
+                self._plan_i += 1
+                if frame_id in self._frames:
+                    self._frames.move_to_end(frame_id)
+                    continue
+            self.__insert(frame_id, self._load(frame_id))
+
+
+@atexit.register
+def close_caches():
+    """ Stop every cache that was not closed before the interpreter shuts down """
+    for cache in list(_OPEN_CACHES):
+        cache.close()
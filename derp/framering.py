@@ -0,0 +1,89 @@
+"""
+A ring of raw camera frames in shared memory. The camera captures straight into the next slot
+and only announces its sequence number over pub/sub, so consumers on the same machine read
+the pixels in place instead of decoding a jpg.
+"""
+import mmap
+import os
+import pathlib
+import numpy as np
+
+SLOT_HEADER = np.dtype([("sequence", np.uint64), ("createNS", np.uint64)])
+SLOT_ALIGN = 64
+
+
+def ring_path(camera_config):
+    return pathlib.Path("/dev/shm") / ("derp_frames_%i" % camera_config["index"])
+
+
+class FrameRing:
+    """ Fixed-size frame slots, each stamped with the sequence number of the frame it holds """
+
+    def __init__(self, path, shape, n_slots, create=False):
+        """
+        Args:
+            path (Path): The shared memory file, created and sized by the camera.
+            shape (tuple): Height, width and depth of every frame.
+            n_slots (int): Frames kept before the oldest is overwritten.
+            create (bool): Whether this is the camera's writable end of the ring.
+        """
+        self.path = path
+        self.shape = tuple(shape)
+        self.n_slots = n_slots
+        header_bytes = SLOT_HEADER.itemsize
+        slot_bytes = header_bytes + int(np.prod(self.shape))
+        slot_bytes = (slot_bytes + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+        size = slot_bytes * n_slots
+        if create:
+            fd = os.open(str(path), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            os.ftruncate(fd, size)
+            self._buffer = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE)
+        else:
+            fd = os.open(str(path), os.O_RDONLY)
+            self._buffer = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        os.close(fd)
+        self.headers = [
+            np.ndarray((), SLOT_HEADER, self._buffer, slot_i * slot_bytes)
+            for slot_i in range(n_slots)
+        ]
+        self.frames = [
+            np.ndarray(self.shape, np.uint8, self._buffer, slot_i * slot_bytes + header_bytes)
+            for slot_i in range(n_slots)
+        ]
+
+    def claim(self, sequence):
+        """ The writable slot for a new frame, marked empty until it is committed """
+        slot_i = sequence % self.n_slots
+        self.headers[slot_i]["sequence"] = 0
+        return self.frames[slot_i]
+
+    def commit(self, sequence, create_ns):
+        """ Publish the claimed slot as holding the frame with this sequence number """
+        header = self.headers[sequence % self.n_slots]
+        header["createNS"] = create_ns
+        header["sequence"] = sequence
+
+    def frame(self, sequence):
+        """ A read-only view of the frame's pixels, None if it was already overwritten """
+        slot_i = sequence % self.n_slots
+        if self.headers[slot_i]["sequence"] != sequence:
+            return None
+        return self.frames[slot_i]
+
+    def is_current(self, sequence):
+        """ Whether the frame is still intact, to check after its view has been used """
+        return self.headers[sequence % self.n_slots]["sequence"] == sequence
+
+
+def create_ring(camera_config):
+    """ The camera's writable ring for frames of its configured size """
+    shape = (camera_config["height"], camera_config["width"], camera_config["depth"])
+    return FrameRing(ring_path(camera_config), shape, camera_config.get("slots", 16), True)
+
+
+def open_ring(camera_config):
+    """ A consumer's read-only view of the camera's ring, None until the camera creates it """
+    if not ring_path(camera_config).exists():
+        return None
+    shape = (camera_config["height"], camera_config["width"], camera_config["depth"])
+    return FrameRing(ring_path(camera_config), shape, camera_config.get("slots", 16))
@@ -0,0 +1,111 @@
+"""
+Low latency single-frame inference for clone models on the car.
+"""
+import collections
+import time
+import torch
+import derp.util
+
+
+class InferenceEngine:
+    """
+    Runs a clone model one thumbnail at a time. The model is traced and frozen once, then every
+    frame is copied into the same preallocated input tensors and run without autograd.
+    """
+
+    def __init__(self, model, thumb_config, n_status, device, compile_model=True, window=1000):
+        """
+        Args:
+            model (Module or ScriptModule): The trained model, taking (thumbs, status) batches.
+            thumb_config (dict): The thumb size the model was trained on.
+            n_status (int): Number of status inputs the model expects.
+            device (torch.device): Where to run the model.
+            compile_model (bool): Trace and freeze the model with TorchScript.
+            window (int): Number of recent per-frame latencies kept for percentiles.
+        """
+        self.device = device
+        shape = (thumb_config["height"], thumb_config["width"], thumb_config["depth"])
+        self.staging = torch.empty(shape, dtype=torch.uint8)
+        self.thumb = torch.zeros((1, shape[2], shape[0], shape[1]), device=device)
+        self.status = torch.zeros((1, n_status), device=device)
+        self.model = model.to(device).eval()
+        if compile_model:
+            self.model = self.compile(self.model)
+        with torch.no_grad():
+            self.prediction = self.model(self.thumb, self.status)[0].detach().cpu().clone()
+        self.latencies = collections.deque(maxlen=window)
+        self.n_predictions = 0
+
+    def compile(self, model):
+        """ Trace and freeze the model unless it is already a TorchScript module """
+        if not isinstance(model, torch.jit.ScriptModule):
+            with torch.no_grad():
+                model = torch.jit.trace(model, (self.thumb, self.status))
+        return torch.jit.freeze(model.eval())
+
+    def predict(self, thumb, status=()):
+        """
+        Run the model on a single HWC uint8 thumbnail and status values. The returned array
+        is a view of a buffer that the next prediction overwrites.
+        """
+        start = time.perf_counter()
+        with torch.inference_mode():
+            self.staging.copy_(torch.from_numpy(thumb))
+            self.thumb[0].copy_(self.staging.permute(2, 0, 1)).div_(255)
+            if len(status):
+                self.status[0].copy_(torch.as_tensor(status, dtype=torch.float32))
+            self.prediction.copy_(self.model(self.thumb, self.status)[0])
+        self.latencies.append(time.perf_counter() - start)
+        self.n_predictions += 1
+        return self.prediction.numpy()
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """ Recent per-frame latencies in milliseconds at the given percentiles """
+        return derp.util.latency_percentiles(self.latencies, percentiles)
+
+
+def load_model(model_path, device):
+    """ A whole pickled model, which newer torch only unpickles when weights_only is off """
+    try:
+        return torch.load(str(model_path), map_location=device, weights_only=False)
+    except TypeError:
+        return torch.load(str(model_path), map_location=device)
+
+
+def load_engine(model_path, thumb_config, n_status, compile_model=True):
+    """ An InferenceEngine for a pickled model on the GPU if there is one """
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = load_model(model_path, device)
+    return InferenceEngine(model, thumb_config, n_status, device, compile_model)
+
+
+def load_int8_engine(model_path, thumb_config, n_status, backend="qnnpack"):
+    """ An InferenceEngine on the CPU for a TorchScript int8 model written by save_int8 """
+    torch.backends.quantized.engine = backend
+    model = torch.jit.load(str(model_path), map_location="cpu")
+    return InferenceEngine(model, thumb_config, n_status, torch.device("cpu"))
+
+
+def save_int8(model, thumb_config, n_status, path):
+    """
+    Trace a quantized model at the car's single-frame input shapes and save it as TorchScript,
+    since eager int8 modules do not survive pickling.
+    """
+    shape = (1, thumb_config["depth"], thumb_config["height"], thumb_config["width"])
+    with torch.no_grad():
+        script = torch.jit.trace(model.eval(), (torch.zeros(shape), torch.zeros((1, n_status))))
+    torch.jit.save(script, str(path))
+
+
+def export_onnx(model, thumb_config, n_status, path):
+    """
+    Write the model as an ONNX graph with the fixed single-frame input shapes the car runs,
+    so it can be driven by derp.runtime without torch or derp.model.
+    """
+    shape = (1, thumb_config["depth"], thumb_config["height"], thumb_config["width"])
+    model = model.cpu().eval()
+    thumb = torch.zeros(shape)
+    status = torch.zeros((1, n_status))
+    with torch.no_grad():
+        torch.onnx.export(model, (thumb, status), str(path), input_names=["thumb", "status"],
+                          output_names=["predict"])
@@ -0,0 +1,72 @@
+"""
+JPEG codecs behind one interface. libjpeg-turbo is used directly through PyTurboJPEG when it
+is installed, and OpenCV otherwise. Both can decode at 1/2, 1/4 or 1/8 scale in the DCT
+domain when only a thumbnail is needed, and can decode into a preallocated buffer.
+"""
+import cv2
+import numpy as np
+
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+
+class OpenCVCodec:
+    """ cv2.imdecode and cv2.imencode, decoding into a buffer costs an extra copy """
+
+    name = "opencv"
+    FLAGS = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }
+
+    def decode(self, jpg, reduction=1, out=None):
+        image = cv2.imdecode(np.frombuffer(jpg, np.uint8), self.FLAGS[reduction])
+        if out is None:
+            return image
+        out[...] = image
+        return out
+
+    def encode(self, image, quality):
+        return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+class TurboCodec:
+    """ libjpeg-turbo through PyTurboJPEG, which decodes straight into a buffer """
+
+    name = "turbojpeg"
+
+    def __init__(self):
+        """ Raises RuntimeError if PyTurboJPEG or the libjpeg-turbo library is missing """
+        if turbojpeg is None:
+            raise RuntimeError("PyTurboJPEG is not installed")
+        self._turbo = turbojpeg.TurboJPEG()
+
+    def decode(self, jpg, reduction=1, out=None):
+        scaling_factor = None if reduction == 1 else (1, reduction)
+        return self._turbo.decode(jpg, turbojpeg.TJPF_BGR, scaling_factor, 0, out)
+
+    def encode(self, image, quality):
+        # 4:2:0 chroma like cv2.imencode, so recordings do not depend on the installed codec
+        return self._turbo.encode(image, quality, turbojpeg.TJPF_BGR, turbojpeg.TJSAMP_420)
+
+
+CODECS = {"opencv": OpenCVCodec, "turbojpeg": TurboCodec}
+
+
+def make_codec(name="auto"):
+    """ The named codec, or turbojpeg when it can be loaded and opencv otherwise for auto """
+    if name != "auto":
+        return CODECS[name]()
+    try:
+        return TurboCodec()
+    except (RuntimeError, OSError):
+        return OpenCVCodec()
+
+
+def reduced_shape(shape, reduction):
+    """ The shape of a frame of the given shape when decoded at 1/reduction scale """
+    return (-(-shape[0] // reduction), -(-shape[1] // reduction)) + tuple(shape[2:])
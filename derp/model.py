@@ -3,7 +3,9 @@ A collection of neural network code. The first part of the script includes
 blocks, which are the building blocks of our models. The second part includes
 the actual Pytorch models.
 """
+import copy
 import torch
+import torch.quantization
 import torchvision.transforms as transforms
 
 
@@ -237,14 +239,90 @@ class StarTree(torch.nn.Module):
         return out
 
 
-def train_epoch(device, model, optimizer, criterion, loader):
-    """ Run the optimzer over all batches in an epoch """
+class QuantizedModel(torch.nn.Module):
+    """
+    Wraps a Tiny or StarTree for eager mode int8 quantization. Camera batches are quantized
+    on the way into the features, and status inputs are joined in float before the head.
+    """
+
+    def __init__(self, model, backend="qnnpack"):
+        """
+        Args:
+            model (Module): A float Tiny or StarTree whose blocks are reused.
+            backend (str): The quantized engine the model will run on, qnnpack for ARM.
+        """
+        super(QuantizedModel, self).__init__()
+        self.n_status = model.n_status
+        self.backend = backend
+        self.quant = torch.quantization.QuantStub()
+        self.feat = model.feat
+        self.view = model.view
+        if self.n_status:
+            self.feat_dequant = torch.quantization.DeQuantStub()
+            self.head_quant = torch.quantization.QuantStub()
+        self.head = model.head
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def fuse(self):
+        """ Fold each block's ReLU into its convolution or linear layer """
+        for block in list(self.feat) + list(self.head):
+            if isinstance(block, ConvBlock) and block.activation:
+                torch.quantization.fuse_modules(block, ["conv2d", "activation"], inplace=True)
+            elif isinstance(block, LinearBlock) and block.activation:
+                torch.quantization.fuse_modules(block, ["linear", "activation"], inplace=True)
+
+    def forward(self, batch, status):
+        """ Forward the 4D batch and status like the wrapped model """
+        # Quantized convolutions may return channels last activations
+        out = self.feat(self.quant(batch)).contiguous()
+        out = self.view(out)
+        if self.n_status:
+            out = torch.cat((self.feat_dequant(out), status), 1)
+            out = self.head_quant(out)
+        return self.dequant(self.head(out))
+
+
+def quantize_static(model, loader, n_batches, backend="qnnpack"):
+    """ An int8 copy of the model with activation ranges calibrated on n_batches of loader """
+    torch.backends.quantized.engine = backend
+    quantized = QuantizedModel(copy.deepcopy(model).cpu().eval(), backend)
+    quantized.fuse()
+    quantized.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        for batch_index, (examples, statuses, _) in enumerate(loader):
+            if batch_index == n_batches:
+                break
+            quantized(examples, statuses)
+    return torch.quantization.convert(quantized, inplace=True)
+
+
+def prepare_qat(model, backend="qnnpack"):
+    """ A copy of the model with fake quantization, to be trained then passed to convert_qat """
+    torch.backends.quantized.engine = backend
+    quantized = QuantizedModel(copy.deepcopy(model).cpu().eval(), backend)
+    quantized.fuse()
+    quantized.qconfig = torch.quantization.get_default_qat_qconfig(backend)
+    return torch.quantization.prepare_qat(quantized.train(), inplace=True)
+
+
+def convert_qat(model):
+    """ The int8 model of a fake quantized model trained after prepare_qat """
+    return torch.quantization.convert(model.cpu().eval(), inplace=True)
+
+
+def train_epoch(device, model, optimizer, criterion, loader, augment=None):
+    """ Run the optimzer over all batches in an epoch, augmenting each batch if asked """
     model.train()
     epoch_loss = 0
     batch_index = 0
     for batch_index, (examples, statuses, labels) in enumerate(loader):
         optimizer.zero_grad()
-        guesses = model(examples.to(device), statuses.to(device))
+        examples = examples.to(device)
+        if augment is not None:
+            with torch.no_grad():
+                examples = augment(examples)
+        guesses = model(examples, statuses.to(device))
         loss = criterion(guesses, labels.to(device))
         loss.backward()
         optimizer.step()
@@ -280,4 +358,105 @@ def compose_transforms(transform_config):
     transform_list.append(transforms.ToTensor())
     return transforms.Compose(transform_list)
 
-    
+
+def rgb_to_grayscale(batch):
+    """ The luma of a 4D RGB batch in [0, 1] as a 4D single-channel batch """
+    red, green, blue = batch.unbind(1)
+    return (0.299 * red + 0.587 * green + 0.114 * blue).unsqueeze(1)
+
+
+def rgb_to_hsv(batch):
+    """ Convert a 4D RGB batch in [0, 1] to HSV with every channel in [0, 1] """
+    red, green, blue = batch.unbind(1)
+    maxc, _ = batch.max(1)
+    minc, _ = batch.min(1)
+    delta = maxc - minc
+    is_gray = delta == 0
+    saturation = delta / torch.where(maxc == 0, torch.ones_like(maxc), maxc)
+    delta = torch.where(is_gray, torch.ones_like(delta), delta)
+    red_hue = (maxc - red) / delta
+    green_hue = (maxc - green) / delta
+    blue_hue = (maxc - blue) / delta
+    hue = torch.where(maxc == red, blue_hue - green_hue, 4.0 + green_hue - red_hue)
+    hue = torch.where(maxc == green, 2.0 + red_hue - blue_hue, hue)
+    hue = torch.where(is_gray, torch.zeros_like(hue), hue)
+    hue = (hue / 6.0) % 1.0
+    return torch.stack((hue, saturation, maxc), 1)
+
+
+def hsv_to_rgb(batch):
+    """ Convert a 4D HSV batch with every channel in [0, 1] back to RGB """
+    hue, saturation, value = batch.unbind(1)
+    sector = torch.floor(hue * 6.0)
+    frac = hue * 6.0 - sector
+    sector = sector.long() % 6
+    p = (value * (1.0 - saturation)).clamp(0.0, 1.0)
+    q = (value * (1.0 - saturation * frac)).clamp(0.0, 1.0)
+    t = (value * (1.0 - saturation * (1.0 - frac))).clamp(0.0, 1.0)
+    choices = torch.stack(
+        (
+            torch.stack((value, q, p, p, t, value), 1),
+            torch.stack((t, value, value, q, p, p), 1),
+            torch.stack((p, p, t, value, value, q), 1),
+        ),
+        1,
+    )
+    index = sector.unsqueeze(1).unsqueeze(2).expand(-1, 3, 1, -1, -1)
+    return choices.gather(2, index).squeeze(2)
+
+
+class BatchColorJitter(torch.nn.Module):
+    """
+    The batched equivalent of torchvision's ColorJitter for 4D RGB batches. Every example
+    gets its own brightness, contrast, saturation and hue factors drawn with the same
+    semantics, and the adjustments are applied in a random order per batch.
+    """
+
+    def __init__(self, brightness=0, contrast=0, saturation=0, hue=0):
+        """ Ranges follow ColorJitter, [max(0, 1 - x), 1 + x] for all but hue's [-x, x] """
+        super(BatchColorJitter, self).__init__()
+        self.ranges = {
+            "brightness": (max(0, 1 - brightness), 1 + brightness) if brightness else None,
+            "contrast": (max(0, 1 - contrast), 1 + contrast) if contrast else None,
+            "saturation": (max(0, 1 - saturation), 1 + saturation) if saturation else None,
+            "hue": (-hue, hue) if hue else None,
+        }
+
+    def forward(self, batch):
+        """ Jitter a float batch in [0, 1] or a uint8 batch in [0, 255] """
+        is_uint8 = batch.dtype == torch.uint8
+        out = batch.float() / 255 if is_uint8 else batch
+        for adjustment_i in torch.randperm(len(self.ranges)).tolist():
+            name = list(self.ranges)[adjustment_i]
+            if self.ranges[name] is None:
+                continue
+            low, high = self.ranges[name]
+            factors = torch.empty(len(out), 1, 1, 1, device=out.device).uniform_(low, high)
+            if name == "brightness":
+                out = (out * factors).clamp(0, 1)
+            elif name == "contrast":
+                mean = rgb_to_grayscale(out).mean(dim=(1, 2, 3), keepdim=True)
+                out = (factors * out + (1 - factors) * mean).clamp(0, 1)
+            elif name == "saturation":
+                gray = rgb_to_grayscale(out)
+                out = (factors * out + (1 - factors) * gray).clamp(0, 1)
+            elif name == "hue":
+                hsv = rgb_to_hsv(out)
+                hue = (hsv[:, :1] + factors) % 1.0
+                out = hsv_to_rgb(torch.cat((hue, hsv[:, 1:]), 1))
+        return (out * 255).round().to(torch.uint8) if is_uint8 else out
+
+
+def compose_batch_transforms(transform_config):
+    """ Batched versions of the image transforms, applied to whole batches after collation """
+    transform_list = []
+    for perturb_config in transform_config:
+        if perturb_config["name"] == "colorjitter":
+            transform = BatchColorJitter(
+                brightness=perturb_config["brightness"],
+                contrast=perturb_config["contrast"],
+                saturation=perturb_config["saturation"],
+                hue=perturb_config["hue"],
+            )
+            transform_list.append(transform)
+    return torch.nn.Sequential(*transform_list)
@@ -1,7 +1,10 @@
 """
 A part is a component of the overall derp system that communicates with other parts
 """
+import collections
+import zmq
 from derp.util import TOPICS, MSG_STEM, init_logger, subscriber, publisher, get_timestamp
+from derp.util import parse_message
 
 class Part:
     """ The root class for every part, includes a bunch of useful functions and cleanup """
@@ -19,12 +22,22 @@ class Part:
         self._pub_context, self._publisher = None, None
         self._is_pubsub_initialized = False
         self._timestamp = 0
+        # Topics where only the newest queued message is handled and older ones are dropped
+        self._conflate = set(self._config.get('conflate', []))
+        self._pending = collections.deque()
+        self._dropped = collections.Counter()
+        self._metric_interval_ns = int(self._config.get('metric_interval', 1.0) * 1e9)
+        self._metric_ns = 0
         if init_pubsub:
             self.init_pubsub()
 
     def __del__(self):
         """ Clean up the pub/sub system """
         self._logger.info("__del__")
+        self.close()
+
+    def close(self):
+        """ Close the pub/sub sockets and their contexts, doing nothing if already closed """
         if self._subscriber:
             self._subscriber.close()
         if self._sub_context:
@@ -33,6 +46,9 @@ class Part:
             self._publisher.close()
         if self._pub_context:
             self._pub_context.term()
+        self._sub_context, self._subscriber = None, None
+        self._pub_context, self._publisher = None, None
+        self._is_pubsub_initialized = False
 
     def init_pubsub(self):
         sub_paths = [MSG_STEM + name for name in self._sub_names]
@@ -52,17 +68,54 @@ class Part:
     def subscribe(self):
         if not self._is_pubsub_initialized:
             return None
-        topic_bytes, message_bytes = self._subscriber.recv_multipart()
+        if self._conflate:
+            self.drain()
+        if not self._pending:
+            self._pending.append(self._subscriber.recv_multipart())
+        topic_bytes, message_bytes = self._pending.popleft()
         self._timestamp = get_timestamp()
         topic = topic_bytes.decode()
-        self._messages[topic] = TOPICS[topic].from_bytes(message_bytes).as_builder()
+        self._messages[topic] = parse_message(TOPICS[topic], message_bytes).as_builder()
+        if self._dropped and self._timestamp - self._metric_ns >= self._metric_interval_ns:
+            self.publish_metrics()
         return topic
 
-    def publish(self, topic, **kwargs):
+    def drain(self):
+        """
+        Queue every message already waiting on the socket without blocking, then drop all but
+        the newest message of each conflated topic. Other topics keep every message in order.
+        """
+        while True:
+            try:
+                self._pending.append(self._subscriber.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        newest = {}
+        for position, (topic_bytes, _) in enumerate(self._pending):
+            if topic_bytes.decode() in self._conflate:
+                newest[topic_bytes] = position
+        kept = collections.deque()
+        for position, (topic_bytes, message_bytes) in enumerate(self._pending):
+            if topic_bytes in newest and newest[topic_bytes] != position:
+                self._dropped[topic_bytes.decode()] += 1
+            else:
+                kept.append((topic_bytes, message_bytes))
+        self._pending = kept
+
+    def publish_metrics(self):
+        """ Publish how many stale messages of each conflated topic this part has dropped """
+        self._metric_ns = self._timestamp
+        for topic, count in sorted(self._dropped.items()):
+            self.publish('metric', name='%s.dropped.%s' % (self._name, topic), value=count)
+
+    def publish(self, topic, create_ns=None, **kwargs):
+        """ Publish a message created at create_ns, by default when the last input arrived """
         if not self._is_pubsub_initialized:
             return None
+        if create_ns is None:
+            create_ns = self._timestamp
         message = TOPICS[topic].new_message(
-            createNS=self._timestamp, publishNS=get_timestamp(), **kwargs
+            createNS=create_ns, publishNS=get_timestamp(), **kwargs
         )
         self._publisher.send_multipart([str.encode(topic), message.to_bytes()])
         return message
@@ -0,0 +1,290 @@
+"""
+Lazy, memory-mapped access to the topic files of a recording. Each topic gets a sidecar
+index of message offsets and publish times so messages can be fetched by position or time
+without reading the whole file into memory.
+
+Repacked recordings keep scalar topics in <topic>.zst instead, zstd-compressed chunks of capnp
+packed messages, which are opened the same way.
+
+The writer also commits each topic file in segments. After a segment's messages are synced
+to disk it appends a checksummed record of the file's end offset to <topic>.seg, so a torn
+tail can only ever follow the last committed offset.
+"""
+import mmap
+import os
+import pathlib
+import struct
+import zipfile
+import zlib
+import numpy as np
+import derp.util
+
+INDEX_DTYPE = np.dtype([("offset", np.int64), ("size", np.int64), ("publishNS", np.int64)])
+SEGMENT_RECORD = struct.Struct("<qqQ")
+
+
+def message_size(buffer, offset):
+    """
+    Size in bytes of the capnp message framed at offset, read only from the segment table.
+    Returns 0 if there is no complete message at offset, such as a torn tail.
+    """
+    end = len(buffer)
+    if offset + 4 > end:
+        return 0
+    n_segments = struct.unpack_from("<I", buffer, offset)[0] + 1
+    header_size = (4 + 4 * n_segments + 7) // 8 * 8
+    if offset + header_size > end:
+        return 0
+    segment_sizes = struct.unpack_from("<%iI" % n_segments, buffer, offset + 4)
+    # Every message has at least its root pointer, zeroed space left by a crash has none
+    if not segment_sizes[0]:
+        return 0
+    size = header_size + 8 * sum(segment_sizes)
+    return size if offset + size <= end else 0
+
+
+def valid_end(buffer, offset=0):
+    """ The end of the last complete message, walking the framing from a message at offset """
+    if offset > len(buffer):
+        offset = 0
+    while True:
+        size = message_size(buffer, offset)
+        if not size:
+            return offset
+        offset += size
+
+
+def index_path(folder, topic):
+    return folder / ("%s.idx.npz" % topic)
+
+
+def columns_path(folder, topic):
+    return folder / ("%s.cols.npz" % topic)
+
+
+def segments_path(folder, topic):
+    return folder / ("%s.seg" % topic)
+
+
+def segment_record(end, count):
+    """ The bytes of a segment record committing the first count messages, ending at end """
+    return SEGMENT_RECORD.pack(end, count, zlib.crc32(struct.pack("<qq", end, count)))
+
+
+def committed_segment(folder, topic):
+    """
+    The (end, count) of the last intact segment record, reading at most the last two records
+    since only the one being appended during a crash can be torn. (0, 0) if there are none.
+    """
+    path = segments_path(folder, topic)
+    if not path.exists():
+        return 0, 0
+    with open(str(path), "rb") as segments_fd:
+        n_records = os.fstat(segments_fd.fileno()).st_size // SEGMENT_RECORD.size
+        for record_i in range(n_records - 1, max(n_records - 2, 0) - 1, -1):
+            segments_fd.seek(record_i * SEGMENT_RECORD.size)
+            end, count, check = SEGMENT_RECORD.unpack(segments_fd.read(SEGMENT_RECORD.size))
+            if check == zlib.crc32(struct.pack("<qq", end, count)):
+                return end, count
+    return 0, 0
+
+
+def topic_end(folder, topic):
+    """
+    The size of a topic file without any torn tail. Only the messages written after the last
+    committed segment are walked, so this takes time bounded by a segment, not the file.
+    """
+    if isinstance(folder, str):
+        folder = pathlib.Path(folder)
+    with derp.util.topic_file_reader(folder, topic) as topic_fd:
+        size = os.fstat(topic_fd.fileno()).st_size
+        committed, _ = committed_segment(folder, topic)
+        if committed > size:
+            committed = 0
+        if not size:
+            return 0
+        with mmap.mmap(topic_fd.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return valid_end(buffer, committed)
+
+
+def truncate_torn(folder, topic):
+    """ Truncate a topic file to its last complete message, returning the bytes removed """
+    if isinstance(folder, str):
+        folder = pathlib.Path(folder)
+    path = folder / ("%s.bin" % topic)
+    size = path.stat().st_size
+    end = topic_end(folder, topic)
+    if end < size:
+        os.truncate(str(path), end)
+    return size - end
+
+
+def file_stat(stat):
+    """ The size and modification time that identify a version of a topic file """
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_cache(path, stat):
+    """ The arrays stored in a sidecar cache if it was built from this version of the file """
+    if not path.exists():
+        return None
+    try:
+        with np.load(str(path)) as cached:
+            if np.array_equal(cached["stat"], stat):
+                return {name: cached[name] for name in cached.files if name != "stat"}
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        # A cache torn by a crash is just rebuilt
+        pass
+    return None
+
+
+def save_cache(path, stat, arrays):
+    """ Atomically write a sidecar cache, silently skipping read-only recordings """
+    # Processes racing to build the same cache each write their own file
+    tmp_path = path.with_suffix(".%i.tmp" % os.getpid())
+    try:
+        with open(str(tmp_path), "wb") as cache_fd:
+            np.savez(cache_fd, stat=stat, **arrays)
+            cache_fd.flush()
+            os.fsync(cache_fd.fileno())
+        tmp_path.rename(path)
+    except OSError:
+        pass
+
+
+class TopicReader:
+    """ Random access to the messages of one topic without reading them into memory """
+
+    def __init__(self, folder, topic):
+        """ Map the topic file, or unpack a packed one, and load or rebuild its stale index """
+        if isinstance(folder, str):
+            folder = pathlib.Path(folder)
+        self.folder = folder
+        self.topic = topic
+        self.schema = derp.util.TOPICS[topic]
+        path = derp.util.topic_path(folder, topic)
+        if path.suffix == ".zst":
+            # Packed topics are small scalar ones, unpacked into memory in the regular framing
+            self._fd = None
+            self._stat = path.stat()
+            self._buffer = derp.util.read_packed_topic(folder, topic)
+        else:
+            self._fd = derp.util.topic_file_reader(folder, topic)
+            self._stat = os.fstat(self._fd.fileno())
+            if self._stat.st_size:
+                self._buffer = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._buffer = b""
+        self.index = self.__load_index()
+        self.times = self.index["publishNS"]
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """ Release the mapping, messages still referencing it keep their pages alive """
+        if isinstance(self._buffer, mmap.mmap):
+            try:
+                self._buffer.close()
+            except BufferError:
+                pass
+        if self._fd is not None:
+            self._fd.close()
+
+    def __load_index(self):
+        """ Use the cached sidecar index if it matches the topic file, otherwise rebuild it """
+        path = index_path(self.folder, self.topic)
+        stat = file_stat(self._stat)
+        cached = load_cache(path, stat)
+        if cached is not None and "index" in cached:
+            return cached["index"]
+        index = self.build_index()
+        save_cache(path, stat, {"index": index})
+        return index
+
+    def build_index(self):
+        """ Walk the message framing once, parsing only enough to know each publish time """
+        rows = []
+        offset = 0
+        while True:
+            size = message_size(self._buffer, offset)
+            if not size:
+                break
+            rows.append((offset, size, self.__parse(offset, size).publishNS))
+            offset += size
+        return np.array(rows, dtype=INDEX_DTYPE)
+
+    def __parse(self, offset, size):
+        data = memoryview(self._buffer)[offset : offset + size]
+        return derp.util.parse_message(self.schema, data)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, message_i):
+        """ Parse the message at the given position directly out of the mapped file """
+        if message_i < 0:
+            message_i += len(self.index)
+        if not 0 <= message_i < len(self.index):
+            raise IndexError("%s message %i out of range" % (self.topic, message_i))
+        row = self.index[message_i]
+        return self.__parse(int(row["offset"]), int(row["size"]))
+
+    def __iter__(self):
+        for message_i in range(len(self.index)):
+            yield self[message_i]
+
+    def search(self, timestamp):
+        """ Position of the first message published at or after the timestamp """
+        return int(np.searchsorted(self.times, timestamp))
+
+    def between(self, start=None, end=None):
+        """ Iterate over the messages published in [start, end) """
+        first = 0 if start is None else self.search(start)
+        last = len(self.index) if end is None else self.search(end)
+        for message_i in range(first, last):
+            yield self[message_i]
+
+
+def open_topics(folder):
+    """ A lazy drop-in for derp.util.load_topics that maps each existing topic file """
+    if isinstance(folder, str):
+        folder = pathlib.Path(folder)
+    return {
+        topic: TopicReader(folder, topic)
+        for topic in derp.util.TOPICS
+        if derp.util.topic_exists(folder, topic)
+    }
+
+
+def load_columns(folder, topic):
+    """
+    The derp.util.TOPIC_COLUMNS arrays of a scalar topic. They are extracted once and cached
+    beside the topic file until its size or modification time changes.
+    """
+    if isinstance(folder, str):
+        folder = pathlib.Path(folder)
+    fields = derp.util.TOPIC_COLUMNS[topic]
+    if not derp.util.topic_exists(folder, topic):
+        return derp.util.extract_columns([], fields)
+    path = columns_path(folder, topic)
+    stat = file_stat(derp.util.topic_path(folder, topic).stat())
+    cached = load_cache(path, stat)
+    if cached is not None and set(fields) <= set(cached):
+        return cached
+    reader = TopicReader(folder, topic)
+    columns = derp.util.extract_columns(reader, fields)
+    reader.close()
+    save_cache(path, stat, columns)
+    return columns
+
+
+def open_columns(folder):
+    """ The cached columns of every scalar topic, empty if a topic was not recorded """
+    return {topic: load_columns(folder, topic) for topic in derp.util.TOPIC_COLUMNS}
+
+
+def load_car_actions(folder):
+    """ derp.util.extract_car_actions computed from the cached action and controller columns """
+    return derp.util.combine_car_actions(load_columns(folder, "action"),
+                                         load_columns(folder, "controller"))
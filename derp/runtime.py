@@ -0,0 +1,53 @@
+"""
+Torch-free inference of exported clone models with onnxruntime. Importing this instead of
+derp.inference keeps torch and derp.model out of the brain process on the car.
+"""
+import collections
+import time
+import numpy as np
+import onnxruntime
+import derp.util
+
+
+class OnnxEngine:
+    """ The derp.inference.InferenceEngine interface over an ONNX graph with fixed shapes """
+
+    def __init__(self, model_path, n_status, n_threads=1, window=1000):
+        """
+        Args:
+            model_path (Path): The model.onnx written by derp.inference.export_onnx.
+            n_status (int): Number of status inputs the model expects.
+            n_threads (int): Threads onnxruntime may use within an operator.
+            window (int): Number of recent per-frame latencies kept for percentiles.
+        """
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = n_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            str(model_path), options, providers=["CPUExecutionProvider"]
+        )
+        inputs = {node.name: node.shape for node in self.session.get_inputs()}
+        self.thumb = np.zeros(inputs["thumb"], dtype=np.float32)
+        self.status = np.zeros((1, n_status), dtype=np.float32)
+        # Graphs that ignore the status drop it as an input
+        self.feed = {"thumb": self.thumb}
+        if "status" in inputs:
+            self.feed["status"] = self.status
+        self.latencies = collections.deque(maxlen=window)
+        self.n_predictions = 0
+
+    def predict(self, thumb, status=()):
+        """ Run the model on a single HWC uint8 thumbnail and status values """
+        start = time.perf_counter()
+        np.divide(thumb.transpose(2, 0, 1), np.float32(255), out=self.thumb[0])
+        if len(status):
+            self.status[0] = status
+        prediction = self.session.run(None, self.feed)[0][0]
+        self.latencies.append(time.perf_counter() - start)
+        self.n_predictions += 1
+        return prediction
+
+    def latency_percentiles(self, percentiles=(50, 90, 99)):
+        """ Recent per-frame latencies in milliseconds at the given percentiles """
+        return derp.util.latency_percentiles(self.latencies, percentiles)
@@ -4,33 +4,79 @@ Common utilities for derp used by various classes.
 from collections import namedtuple
 import cv2
 from datetime import datetime
+import functools
 import heapq
 import logging
 import pathlib
 import numpy as np
 import os
 import socket
+import struct
 import time
 import yaml
+import zlib
 import zmq
 import capnp
 import messages_capnp
+import derp.jpeg
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 Bbox = namedtuple("Bbox", ["x", "y", "w", "h"])
 
 TOPICS = {
     "camera": messages_capnp.Camera,
+    "frame": messages_capnp.Frame,
     "controller": messages_capnp.Controller,
     "action": messages_capnp.Action,
     "imu": messages_capnp.Imu,
     "quality": messages_capnp.Quality,
+    "metric": messages_capnp.Metric,
+}
+
+# The typed columns kept for each scalar topic, list fields become fixed-width rows
+TOPIC_COLUMNS = {
+    "action": {
+        "publishNS": np.int64,
+        "isManual": bool,
+        "speed": np.float32,
+        "steer": np.float32,
+    },
+    "controller": {
+        "publishNS": np.int64,
+        "isAutonomous": bool,
+        "speedOffset": np.float32,
+        "steerOffset": np.float32,
+        "exit": bool,
+    },
+    "imu": {
+        "publishNS": np.int64,
+        "index": np.int8,
+        "isCalibrated": bool,
+        "angularVelocity": (np.float32, 3),
+        "magneticField": (np.float32, 3),
+        "linearAcceleration": (np.float32, 3),
+        "gravity": (np.float32, 3),
+        "orientationQuaternion": (np.float32, 4),
+        "temperature": np.float32,
+    },
+    "quality": {
+        "publishNS": np.int64,
+        "quality": np.int8,
+    },
 }
 
 DERP_ROOT = pathlib.Path(os.environ["DERP_ROOT"])
 MODEL_ROOT = DERP_ROOT / "models"
 RECORDING_ROOT = DERP_ROOT / "recordings"
+DATASET_ROOT = DERP_ROOT / "datasets"
 CONFIG_ROOT = DERP_ROOT / "config"
 MSG_STEM = "/tmp/derp_"
+# The compressed size and message count before each zstd chunk of a packed topic file
+PACKED_CHUNK = struct.Struct("<QQ")
 
 
 def is_already_running(path):
@@ -74,10 +120,28 @@ def make_recording_path():
     return folder
 
 
+def sample_rng(seed, name, *counters):
+    """
+    A counter-based random stream that depends only on the seed, a name such as a recording's
+    and up to three integer counters, so samples can be drawn in any order or process and
+    still be reproducible. The lowest counter word is left for the draws themselves.
+    """
+    key = [seed & 0xFFFFFFFFFFFFFFFF, zlib.crc32(name.encode())]
+    counter = [0] + list(counters) + [0] * (3 - len(counters))
+    return np.random.Generator(np.random.Philox(key=key, counter=counter))
+
+
 def get_timestamp():
     return int(time.time() * 1e9)
 
 
+def latency_percentiles(latencies, percentiles=(50, 90, 99)):
+    """ Latencies given in seconds as milliseconds at each percentile, zeros if there are none """
+    if not latencies:
+        return [0.0 for _ in percentiles]
+    return [float(x) for x in np.percentile(np.array(latencies) * 1000, percentiles)]
+
+
 def publisher(path):
     context = zmq.Context()
     sock = context.socket(zmq.PUB)
@@ -96,19 +160,88 @@ def subscriber(paths):
     return context, sock
 
 
+def parse_message(schema, data):
+    """
+    The single capnp message framed in data, read without copying. Newer pycapnp only parses
+    from_bytes inside a context manager, read_multiple_bytes works the same on every version.
+    """
+    return next(iter(schema.read_multiple_bytes(data)))
+
+
 def topic_file_reader(folder, topic):
     return open("%s/%s.bin" % (folder, topic), "rb")
 
 
-def topic_exists(folder, topic):
+def packed_topic_path(folder, topic):
+    return folder / ("%s.zst" % topic)
+
+
+def topic_path(folder, topic):
+    """ The topic's file, its packed form if the recording was repacked """
     path = folder / ("%s.bin" % topic)
-    return path.exists()
+    return path if path.exists() else packed_topic_path(folder, topic)
+
+
+def topic_exists(folder, topic):
+    return topic_path(folder, topic).exists()
 
 
 def topic_file_writer(folder, topic):
     return open("%s/%s.bin" % (folder, topic), "wb")
 
 
+def require_zstandard():
+    """ The zstandard module, raising RuntimeError if it is missing since packed topics need it """
+    if zstandard is None:
+        raise RuntimeError("zstandard is not installed, packed topic files need it")
+    return zstandard
+
+
+def write_packed_topic(folder, topic, messages, chunk_size=4096, level=10):
+    """
+    Write messages as a packed topic file, a series of zstd-compressed chunks of capnp packed
+    messages each after its PACKED_CHUNK header. The file only appears once it is complete.
+    Returns the number of messages written.
+    """
+    path = packed_topic_path(folder, topic)
+    tmp_path = path.with_suffix(".tmp")
+    compressor = require_zstandard().ZstdCompressor(level=level)
+    n_messages = 0
+    with open(str(tmp_path), "wb") as packed_fd:
+        chunk = []
+        for msg in messages:
+            chunk.append(msg.as_builder().to_bytes_packed())
+            if len(chunk) == chunk_size:
+                data = compressor.compress(b"".join(chunk))
+                packed_fd.write(PACKED_CHUNK.pack(len(data), len(chunk)) + data)
+                n_messages += len(chunk)
+                chunk = []
+        if chunk:
+            data = compressor.compress(b"".join(chunk))
+            packed_fd.write(PACKED_CHUNK.pack(len(data), len(chunk)) + data)
+            n_messages += len(chunk)
+        packed_fd.flush()
+        os.fsync(packed_fd.fileno())
+    tmp_path.rename(path)
+    return n_messages
+
+
+def read_packed_topic(folder, topic):
+    """ The messages of a packed topic file unpacked into the framing of a regular one """
+    decompressor = require_zstandard().ZstdDecompressor()
+    out = bytearray()
+    with open(str(packed_topic_path(folder, topic)), "rb") as packed_fd:
+        while True:
+            header = packed_fd.read(PACKED_CHUNK.size)
+            if len(header) < PACKED_CHUNK.size:
+                break
+            size, _ = PACKED_CHUNK.unpack(header)
+            data = decompressor.decompress(packed_fd.read(size))
+            for msg in TOPICS[topic].read_multiple_bytes_packed(data):
+                out += msg.as_builder().to_bytes()
+    return bytes(out)
+
+
 def print_image_config(name, config):
     """ Prints some useful variables about the camera for debugging purposes """
     top = config["pitch"] + config["vfov"] / 2
@@ -157,35 +290,97 @@ def resize(image, size):
     return cv2.resize(image, size, interpolation=interpolation)
 
 
-def perturb(frame, camera_config, shift=0, rotate=0):
+@functools.lru_cache(maxsize=32)
+def ground_widths(height, hfov, vfov, pitch, z):
+    """
+    The width in meters of the ground seen by each of the height image rows, assuming fixed
+    degrees per pixel. Rows at or above the horizon see no ground and are marked with nan.
+    """
+    # Figure out where the horizon is in the image
+    horizon_frac = ((vfov / 2) + pitch) / vfov
+    vertical_fracs = np.linspace(0, 1, height)
+    is_ground = vertical_fracs > horizon_frac
+    ground_angles = (vertical_fracs[is_ground] - horizon_frac) * vfov
+    ground_distances = z / np.tan(deg2rad(ground_angles))
+    widths = np.full(height, np.nan)
+    widths[is_ground] = 2 * ground_distances * np.tan(deg2rad(hfov) / 2)
+    widths.setflags(write=False)
+    return widths
+
+
+@functools.lru_cache(maxsize=8)
+def identity_maps(height, width):
+    """ The cv2.remap x and y maps that leave a height x width image unchanged """
+    map_x, map_y = np.meshgrid(np.arange(width, dtype=np.float32),
+                               np.arange(height, dtype=np.float32))
+    map_x.setflags(write=False)
+    map_y.setflags(write=False)
+    return map_x, map_y
+
+
+def perturb_magnitudes(height, camera_config, shift=0, rotate=0):
+    """ How many pixels to roll each image row by to fake a shift in meters and a rotation """
+    widths = ground_widths(height, camera_config["hfov"], camera_config["vfov"],
+                           camera_config["pitch"], camera_config["z"])
     # Estimate how many pixels to rotate by, assuming fixed degrees per pixel
     pixels_per_degree = camera_config["width"] / camera_config["hfov"]
+    magnitudes = np.full(height, rotate * pixels_per_degree)
+    is_ground = ~np.isnan(widths)
+    magnitudes[is_ground] += (shift / widths[is_ground]) * camera_config["width"]
+    return (magnitudes + 0.5 * np.sign(magnitudes)).astype(np.int64)
 
-    # Figure out where the horizon is in the image
-    horizon_frac = ((camera_config["vfov"] / 2) + camera_config["pitch"]) / camera_config["vfov"]
-
-    # For each row in the frame shift/rotate it
-    indexs = np.arange(len(frame))
-    vertical_fracs = np.linspace(0, 1, len(frame))
-
-    # For each vertical line, apply shift/rotation rolls
-    for index, vertical_frac in zip(indexs, vertical_fracs):
-        magnitude = rotate * pixels_per_degree
-        if vertical_frac > horizon_frac:
-            ground_angle = (vertical_frac - horizon_frac) * camera_config["vfov"]
-            ground_distance = camera_config["z"] / np.tan(deg2rad(ground_angle))
-            ground_width = 2 * ground_distance * np.tan(deg2rad(camera_config["hfov"]) / 2)
-            magnitude += (shift / ground_width) * camera_config["width"]
-        magnitude = int(magnitude + 0.5 * np.sign(magnitude))
-        if magnitude > 0:
-            frame[index, magnitude:, :] = frame[index, : frame.shape[1] - magnitude]
-            frame[index, :magnitude, :] = 0
-        elif magnitude < 0:
-            frame[index, :magnitude, :] = frame[index, abs(magnitude) :]
-            frame[index, frame.shape[1] + magnitude :] = 0
+
+def perturb(frame, camera_config, shift=0, rotate=0):
+    """ Shift and rotate the frame in place by rolling each row, filling the gap with 0 """
+    height, width = frame.shape[:2]
+    magnitudes = perturb_magnitudes(height, camera_config, shift, rotate)
+    if not magnitudes.any():
+        return frame
+    map_x, map_y = identity_maps(height, width)
+    map_x = map_x - magnitudes[:, None].astype(np.float32)
+    frame[...] = cv2.remap(frame, map_x, map_y, cv2.INTER_NEAREST,
+                           borderMode=cv2.BORDER_CONSTANT, borderValue=0)
     return frame
 
 
+def perturb_patch(frame, camera_config, bbox, shift=0, rotate=0):
+    """
+    The same pixels as crop(perturb(frame, camera_config, shift, rotate), bbox) but only the
+    pixels inside the bbox are warped, and the frame is left untouched.
+    """
+    height, width = frame.shape[:2]
+    magnitudes = perturb_magnitudes(height, camera_config, shift, rotate)
+    map_x, map_y = identity_maps(height, width)
+    map_x = crop(map_x, bbox) - magnitudes[bbox.y : bbox.y + bbox.h, None].astype(np.float32)
+    map_y = np.ascontiguousarray(crop(map_y, bbox))
+    return cv2.remap(frame, map_x, map_y, cv2.INTER_NEAREST,
+                     borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+def jpg_reduction(bbox, size):
+    """ The largest libjpeg decode reduction that still leaves the bbox at least size (w, h) """
+    for reduction in (8, 4, 2):
+        if bbox.w / reduction >= size[0] and bbox.h / reduction >= size[1]:
+            return reduction
+    return 1
+
+
+def scale_reduction(scale):
+    """ The largest libjpeg decode reduction that is still at least the given scale """
+    for reduction in (8, 4, 2):
+        if scale * reduction <= 1:
+            return reduction
+    return 1
+
+
+def reduce_config(camera_config, reduction):
+    """ The camera config of frames decoded at a 1/reduction scale """
+    reduced_config = dict(camera_config)
+    reduced_config["width"] = -(-camera_config["width"] // reduction)
+    reduced_config["height"] = -(-camera_config["height"] // reduction)
+    return reduced_config
+
+
 def deg2rad(val):
     return val * np.pi / 180
 
@@ -227,15 +422,47 @@ def dump_config(config, config_path):
 
 
 def extract_latest(desired_times, source_times, source_values):
-    out = []
-    pos = 0
-    val = 0
-    for desired_time in desired_times:
-        while pos < len(source_times) and source_times[pos] < desired_time:
-            val = source_values[pos]
-            pos += 1
-        out.append(val)
-    return np.array(out)
+    """ For each desired time, the last source value published strictly before it, else 0 """
+    source_values = np.asarray(source_values)
+    if not len(source_values):
+        return np.zeros(len(desired_times), dtype=np.int64)
+    n_before = np.searchsorted(source_times, desired_times, side="left")
+    return np.where(n_before > 0, source_values[np.maximum(n_before - 1, 0)], 0)
+
+
+def column_aggregate(values, n_columns, ufunc=None):
+    """
+    Downsample values to one per pixel column, value i falling in column i * n_columns // n.
+    Each column is averaged, or reduced with a ufunc such as np.maximum, and columns between the
+    values of an array shorter than the columns repeat the next value.
+    """
+    values = np.asarray(values)
+    starts = np.minimum(-(-np.arange(n_columns) * len(values) // n_columns), len(values) - 1)
+    if ufunc is not None:
+        return ufunc.reduceat(values, starts)
+    counts = np.diff(np.append(starts, len(values)))
+    return np.add.reduceat(values.astype(np.float64), starts) / np.maximum(counts, 1)
+
+
+def extract_columns(messages, fields):
+    """ Read the fields of every message into a NumPy array per field, enums as their values """
+    dtypes = {field: np.dtype(fields[field]) for field in fields}
+    columns = {field: [] for field in fields}
+    for msg in messages:
+        for field in fields:
+            value = getattr(msg, field)
+            if dtypes[field].shape:
+                width = dtypes[field].shape[0]
+                value = list(value) if len(value) == width else [np.nan] * width
+            elif hasattr(value, "raw"):
+                value = value.raw
+            columns[field].append(value)
+    return {
+        field: np.array(columns[field], dtype=dtypes[field].base).reshape(
+            (-1,) + dtypes[field].shape
+        )
+        for field in fields
+    }
 
 
 def load_topics(folder):
@@ -245,42 +472,78 @@ def load_topics(folder):
     for topic in TOPICS:
         if not topic_exists(folder, topic):
             continue
+        if topic_path(folder, topic).suffix == ".zst":
+            data = read_packed_topic(folder, topic)
+            out[topic] = [msg for msg in TOPICS[topic].read_multiple_bytes(data)]
+            continue
         topic_fd = topic_file_reader(folder, topic)
         out[topic] = [msg for msg in TOPICS[topic].read_multiple(topic_fd)]
         topic_fd.close()
     return out
 
 
-def replay(topics):
-    heap = []
-    for topic in topics:
-        for msg in topics[topic]:
-            heapq.heappush(heap, [msg.publishNS, topic, msg])
-    while heap:
-        yield heapq.heappop(heap)
+def topic_stream(topic, messages, start=None, end=None):
+    """ Yield [publishNS, topic, msg] for the time-sorted messages published in [start, end) """
+    if hasattr(messages, "between"):
+        messages = messages.between(start, end)
+    for msg in messages:
+        if start is not None and msg.publishNS < start:
+            continue
+        if end is not None and msg.publishNS >= end:
+            break
+        yield [msg.publishNS, topic, msg]
+
+
+def replay(topics, start=None, end=None, names=None):
+    """
+    Lazily merge the per-topic streams in publish order, optionally limited to the topics in
+    names and to messages published in [start, end). Ties go to topics in alphabetical order.
+    """
+    streams = [
+        topic_stream(topic, topics[topic], start, end)
+        for topic in sorted(topics)
+        if names is None or topic in names
+    ]
+    yield from heapq.merge(*streams, key=lambda item: item[0])
+
 
+# Set DERP_JPG_CODEC to opencv or turbojpeg to pick a codec, by default turbojpeg if it loads
+JPG_CODEC = derp.jpeg.make_codec(os.environ.get("DERP_JPG_CODEC", "auto"))
 
-def decode_jpg(jpg):
-    return cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
+
+def decode_jpg(jpg, reduction=1, out=None):
+    """
+    Decode a jpg, optionally downscaled by 2, 4 or 8 in the DCT domain by libjpeg and
+    optionally into a preallocated buffer of the decoded shape
+    """
+    return JPG_CODEC.decode(jpg, reduction, out)
 
 
 def encode_jpg(image, quality):
-    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tostring()
+    return JPG_CODEC.encode(image, quality)
 
 
 def extract_car_actions(topics):
-    out = []
-    autonomous = False
-    speed_offset = 0
-    steer_offset = 0
-    for timestamp, topic, msg in replay(topics):
-        if topic == "controller":
-            autonomous = msg.isAutonomous
-            speed_offset = msg.speedOffset
-            steer_offset = msg.steerOffset
-        elif topic == "action":
-            if autonomous or msg.isManual:
-                out.append([timestamp, msg.speed + speed_offset, msg.steer + steer_offset])
-    if not out:
-        out.append([0, 0, 0])
-    return np.array(out)
+    """
+    The [timestamp, speed, steer] of every action the car executed, with the controller
+    offsets applied. Each action sees the last controller state published strictly before it.
+    """
+    actions = extract_columns(topics.get("action", []), TOPIC_COLUMNS["action"])
+    controls = extract_columns(topics.get("controller", []), TOPIC_COLUMNS["controller"])
+    return combine_car_actions(actions, controls)
+
+
+def combine_car_actions(actions, controls):
+    """ extract_car_actions over action and controller columns from extract_columns """
+    # Prepend the initial controller state so every action has a state to index into
+    control_i = np.searchsorted(controls["publishNS"], actions["publishNS"], side="left")
+    autonomous = np.concatenate(([False], controls["isAutonomous"]))[control_i]
+    speed_offset = np.concatenate(([0.0], controls["speedOffset"]))[control_i]
+    steer_offset = np.concatenate(([0.0], controls["steerOffset"]))[control_i]
+
+    executed = autonomous | actions["isManual"]
+    if not executed.any():
+        return np.array([[0, 0, 0]])
+    speeds = actions["speed"][executed] + speed_offset[executed]
+    steers = actions["steer"][executed] + steer_offset[executed]
+    return np.column_stack([actions["publishNS"][executed], speeds, steers])
@@ -1,22 +1,173 @@
 """The disk writer class that records all derp agent messages."""
+import os
+import queue
+import threading
+import time
+from derp.framering import open_ring
 from derp.part import Part
+import derp.recording
 import derp.util
 
+
+class BatchWriter:
+    """
+    Buffers serialized messages per topic and writes them out from its own I/O thread, so a
+    slow disk backs up a bounded queue instead of the subscriber socket.
+    """
+
+    def __init__(self, files, logger, queue_size=1000, buffer_sizes=None, fsync_interval=1.0,
+                 stats_interval=10.0, segment_files=None, segment_size=16777216):
+        """
+        Args:
+            files (dict): The open file of each topic.
+            logger (Logger): Where back-pressure stats are written.
+            queue_size (int): Messages waiting for the I/O thread before new ones are dropped.
+            buffer_sizes (dict): Bytes buffered per topic before writing, with a default entry.
+            fsync_interval (float): Seconds between writing out every buffer and syncing the
+                files to disk, 0 to leave syncing to the OS.
+            stats_interval (float): Seconds between logs of queue depth, bytes/s and drops.
+            segment_files (dict): The open segment record file of each topic, if any. Every
+                sync closes a segment and commits its end offset there once it is on disk.
+            segment_size (int): Bytes of a topic after which its segment is closed early.
+        """
+        self._files = files
+        self._logger = logger
+        self._queue = queue.Queue(queue_size)
+        buffer_sizes = {} if buffer_sizes is None else buffer_sizes
+        default_size = buffer_sizes.get("default", 65536)
+        self._buffer_sizes = {topic: buffer_sizes.get(topic, default_size) for topic in files}
+        self._buffers = {topic: bytearray() for topic in files}
+        self._fsync_interval = fsync_interval
+        self._stats_interval = stats_interval
+        self._segment_files = segment_files
+        self._segment_size = segment_size
+        self._ends = {topic: 0 for topic in files}
+        self._counts = {topic: 0 for topic in files}
+        self._committed = {topic: 0 for topic in files}
+        self.n_dropped = 0
+        self.n_bytes = 0
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def put(self, topic, data):
+        """ Queue a serialized message without blocking, dropping it if the queue is full """
+        try:
+            self._queue.put_nowait((topic, data))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def close(self):
+        """ Write out everything queued or buffered, sync and close the files """
+        self._queue.put(None)
+        self._thread.join()
+        for topic_fd in self._files.values():
+            topic_fd.close()
+        for segments_fd in (self._segment_files or {}).values():
+            segments_fd.close()
+
+    def __write(self, topic):
+        buffer = self._buffers[topic]
+        if buffer:
+            self._files[topic].write(buffer)
+            self.n_bytes += len(buffer)
+            self._ends[topic] += len(buffer)
+            buffer.clear()
+
+    def __commit(self, topic, fsync):
+        """ Write out the topic's buffer and, once it is on disk, record the segment's end """
+        self.__write(topic)
+        topic_fd = self._files[topic]
+        topic_fd.flush()
+        if not fsync:
+            return
+        os.fsync(topic_fd.fileno())
+        if self._segment_files and self._ends[topic] > self._committed[topic]:
+            segments_fd = self._segment_files[topic]
+            segments_fd.write(derp.recording.segment_record(self._ends[topic], self._counts[topic]))
+            segments_fd.flush()
+            self._committed[topic] = self._ends[topic]
+
+    def __sync(self, fsync):
+        for topic in self._files:
+            self.__commit(topic, fsync)
+
+    def __run(self):
+        """ Batch queued messages into per-topic buffers, writing each when it fills up """
+        last_sync = last_stats = time.monotonic()
+        last_bytes = 0
+        poll = min(x for x in (self._fsync_interval, self._stats_interval, 1.0) if x > 0)
+        while True:
+            try:
+                item = self._queue.get(timeout=poll)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                topic, data = item
+                self._buffers[topic] += data
+                self._counts[topic] += 1
+                if len(self._buffers[topic]) >= self._buffer_sizes[topic]:
+                    self.__write(topic)
+                uncommitted = self._ends[topic] - self._committed[topic]
+                if self._segment_files and uncommitted >= self._segment_size:
+                    self.__commit(topic, True)
+            now = time.monotonic()
+            if now - last_sync >= (self._fsync_interval or poll):
+                self.__sync(self._fsync_interval > 0)
+                last_sync = now
+            if self._stats_interval and now - last_stats >= self._stats_interval:
+                self._logger.info(
+                    "queue depth %i, %.0f bytes/s written, %i dropped",
+                    self._queue.qsize(), (self.n_bytes - last_bytes) / (now - last_stats),
+                    self.n_dropped,
+                )
+                last_stats, last_bytes = now, self.n_bytes
+        self.__sync(True)
+
+
 class Writer(Part):
     """The disk writer class that records all derp agent messages."""
 
     def __init__(self, config):
         """Using a dict config connects to all possible subscriber sources"""
         super(Writer, self).__init__(config, "writer", ["brain", "camera", "imu", "joystick"])
+        recording_path = self._global_config['recording_path']
         self._files = {
-            topic: derp.util.topic_file_writer(self._global_config['recording_path'], topic)
+            topic: derp.util.topic_file_writer(recording_path, topic)
             for topic in derp.util.TOPICS
+            if topic != "frame"
         }
+        self._segment_files = {
+            topic: open(str(derp.recording.segments_path(recording_path, topic)), "wb")
+            for topic in self._files
+        }
+        self._batch = BatchWriter(
+            self._files,
+            self._logger,
+            self._config.get("queue_size", 1000),
+            self._config.get("buffer_sizes"),
+            self._config.get("fsync_interval", 1.0),
+            self._config.get("stats_interval", 10.0),
+            self._segment_files,
+            self._config.get("segment_size", 16777216),
+        )
+        self._ring = None
+        self._missed_frames = 0
+        # Shared frames are copied out of the ring here and encoded on a thread of their own
+        self._frames = queue.Queue(self._config.get("encode_queue", 4))
+        self._encoder = threading.Thread(
+            target=encode_frames,
+            args=(self._frames, self._batch, self._global_config["camera"]["quality"]),
+            daemon=True,
+        )
+        self._encoder.start()
 
     def __del__(self):
         super(Writer, self).__del__()
-        for name in self._files:
-            self._files[name].close()
+        self._frames.put(None)
+        self._encoder.join()
+        self._batch.close()
 
     def run(self):
         """
@@ -25,6 +176,50 @@ class Writer(Part):
         to this folder until another state message tells us to stop.
         """
         topic = self.subscribe()
+        if topic == "frame":
+            self.write_frame(self._messages[topic])
+            return True
         self._messages[topic].writeNS = derp.util.get_timestamp()
-        self._messages[topic].write(self._files[topic])
+        self._batch.put(topic, self._messages[topic].to_bytes())
         return topic != "controller" or not self._messages[topic].exit
+
+    def write_frame(self, frame_msg):
+        """
+        Copy a frame shared by the camera out of its ring and queue it for the encoder thread,
+        which records it as a regular camera message. Frames the encoder cannot keep up with
+        are missed rather than blocking the subscriber.
+        """
+        if self._ring is None:
+            self._ring = open_ring(self._global_config["camera"])
+        frame = None if self._ring is None else self._ring.frame(frame_msg.sequence)
+        if frame is not None:
+            frame = frame.copy()
+        if frame is not None and self._ring.is_current(frame_msg.sequence):
+            try:
+                self._frames.put_nowait(
+                    (frame, frame_msg.createNS, frame_msg.publishNS, frame_msg.index)
+                )
+                return
+            except queue.Full:
+                pass
+        self._missed_frames += 1
+        self._logger.warning("missed frame %i, %i in total", frame_msg.sequence,
+                             self._missed_frames)
+
+
+def encode_frames(frames, batch, quality):
+    """ Encode queued frames into camera messages for the batch writer until a None arrives """
+    while True:
+        item = frames.get()
+        if item is None:
+            return
+        frame, create_ns, publish_ns, index = item
+        jpg = derp.util.encode_jpg(frame, quality)
+        camera_msg = derp.util.TOPICS["camera"].new_message(
+            createNS=create_ns,
+            publishNS=publish_ns,
+            writeNS=derp.util.get_timestamp(),
+            index=index,
+            jpg=jpg,
+        )
+        batch.put("camera", camera_msg.to_bytes())
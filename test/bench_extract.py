@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of extract_car_actions and extract_latest against the original pure-Python
+versions on a synthetic recording, verifying that both produce identical results. The original
+versions and the heap-based replay they iterate are kept here verbatim.
+"""
+import argparse
+import heapq
+import time
+import numpy as np
+import derp.util
+
+
+def legacy_extract_latest(desired_times, source_times, source_values):
+    out = []
+    pos = 0
+    val = 0
+    for desired_time in desired_times:
+        while pos < len(source_times) and source_times[pos] < desired_time:
+            val = source_values[pos]
+            pos += 1
+        out.append(val)
+    return np.array(out)
+
+
+def legacy_replay(topics):
+    heap = []
+    for topic in topics:
+        for msg in topics[topic]:
+            heapq.heappush(heap, [msg.publishNS, topic, msg])
+    while heap:
+        yield heapq.heappop(heap)
+
+
+def legacy_extract_car_actions(topics):
+    out = []
+    autonomous = False
+    speed_offset = 0
+    steer_offset = 0
+    for timestamp, topic, msg in legacy_replay(topics):
+        if topic == "controller":
+            autonomous = msg.isAutonomous
+            speed_offset = msg.speedOffset
+            steer_offset = msg.steerOffset
+        elif topic == "action":
+            if autonomous or msg.isManual:
+                out.append([timestamp, msg.speed + speed_offset, msg.steer + steer_offset])
+    if not out:
+        out.append([0, 0, 0])
+    return np.array(out)
+
+
+def synthetic_topics(n_messages, seed=0):
+    """ Camera, action and controller messages at roughly 30, 90 and 3 Hz """
+    rng = np.random.RandomState(seed)
+    n_camera, n_controller = n_messages // 4, n_messages // 100
+    n_action = n_messages - n_camera - n_controller
+    duration = n_action * 11000000
+    topics = {"camera": [], "action": [], "controller": []}
+    for timestamp in np.sort(rng.randint(0, duration, n_camera)):
+        topics["camera"].append(
+            derp.util.TOPICS["camera"].new_message(publishNS=int(timestamp)).as_reader()
+        )
+    for timestamp in np.sort(rng.randint(0, duration, n_action)):
+        msg = derp.util.TOPICS["action"].new_message(
+            publishNS=int(timestamp),
+            isManual=bool(rng.rand() < 0.5),
+            speed=float(rng.rand()),
+            steer=float(rng.rand() * 2 - 1),
+        )
+        topics["action"].append(msg.as_reader())
+    for timestamp in np.sort(rng.randint(0, duration, n_controller)):
+        msg = derp.util.TOPICS["controller"].new_message(
+            publishNS=int(timestamp),
+            isAutonomous=bool(rng.rand() < 0.5),
+            speedOffset=float(rng.rand() * 0.1),
+            steerOffset=float(rng.rand() * 0.1),
+        )
+        topics["controller"].append(msg.as_reader())
+    return topics
+
+
+def timed(func, *args):
+    start = time.time()
+    out = func(*args)
+    return out, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000, help="synthetic recording size")
+    args = parser.parse_args()
+
+    topics = synthetic_topics(args.messages)
+    camera_times = [msg.publishNS for msg in topics["camera"]]
+
+    legacy_actions, legacy_duration = timed(legacy_extract_car_actions, topics)
+    actions, duration = timed(derp.util.extract_car_actions, topics)
+    assert np.array_equal(actions, legacy_actions)
+    print("extract_car_actions %8.3fs -> %8.3fs %6.1fx" %
+          (legacy_duration, duration, legacy_duration / duration))
+
+    action_columns = derp.util.extract_columns(topics["action"], derp.util.TOPIC_COLUMNS["action"])
+    controller_columns = derp.util.extract_columns(topics["controller"],
+                                                   derp.util.TOPIC_COLUMNS["controller"])
+    actions, duration = timed(derp.util.combine_car_actions, action_columns, controller_columns)
+    assert np.array_equal(actions, legacy_actions)
+    print("  from columns      %8.3fs -> %8.3fs %6.1fx" %
+          (legacy_duration, duration, legacy_duration / duration))
+
+    legacy_speeds, legacy_duration = timed(legacy_extract_latest, camera_times,
+                                           legacy_actions[:, 0], legacy_actions[:, 1])
+    speeds, duration = timed(derp.util.extract_latest, camera_times, actions[:, 0], actions[:, 1])
+    assert np.array_equal(speeds, legacy_speeds)
+    print("extract_latest      %8.3fs -> %8.3fs %6.1fx" %
+          (legacy_duration, duration, legacy_duration / duration))
+
+
+if __name__ == "__main__":
+    main()
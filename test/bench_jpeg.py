@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of every available jpg codec over the sample images in this folder, decoding
+at each libjpeg reduction with and without a preallocated buffer and encoding at full size.
+"""
+import argparse
+import pathlib
+import time
+import numpy as np
+import derp.jpeg
+
+
+def per_call(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def available_codecs():
+    codecs = []
+    for name in derp.jpeg.CODECS:
+        try:
+            codecs.append(derp.jpeg.make_codec(name))
+        except (RuntimeError, OSError) as error:
+            print("skip %s: %s" % (name, error))
+    return codecs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20, help="calls timed per measurement")
+    parser.add_argument("--quality", type=int, default=80, help="jpg quality of the recordings")
+    args = parser.parse_args()
+
+    codecs = available_codecs()
+    reference = derp.jpeg.OpenCVCodec()
+    for path in sorted(pathlib.Path(__file__).parent.glob("*.jpg")):
+        image = reference.decode(path.read_bytes())
+        jpg = reference.encode(image, args.quality)
+        print("%s %ix%i" % (path.name, image.shape[1], image.shape[0]))
+        for codec in codecs:
+            duration = per_call(lambda: codec.encode(image, args.quality), args.repeat)
+            print("  %-9s encode     %8.3fms" % (codec.name, duration))
+            for reduction in (1, 2, 4, 8):
+                decoded = codec.decode(jpg, reduction)
+                out = np.empty(derp.jpeg.reduced_shape(image.shape, reduction), np.uint8)
+                assert decoded.shape == out.shape
+                assert codec.decode(jpg, reduction, out) is out
+                duration = per_call(lambda: codec.decode(jpg, reduction), args.repeat)
+                buffered = per_call(lambda: codec.decode(jpg, reduction, out), args.repeat)
+                print("  %-9s decode 1/%i %8.3fms %8.3fms into buffer" %
+                      (codec.name, reduction, duration, buffered))
+
+
+if __name__ == "__main__":
+    main()
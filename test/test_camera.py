@@ -0,0 +1,98 @@
+import threading
+import time
+import numpy as np
+import derp.camera
+import derp.util
+
+
+class FakeCapture:
+    """ Hands out numbered frames as fast as they are read """
+
+    def __init__(self):
+        self.count = 0
+
+    def read(self, image=None):
+        self.count += 1
+        return True, np.full((48, 64, 3), self.count, dtype=np.uint8)
+
+    def release(self):
+        pass
+
+
+def test_async_encoding(tmp_path, monkeypatch):
+    """ verify frames are encoded off the capture loop and keep their capture times """
+    monkeypatch.setattr(derp.util, "encode_jpg", lambda *args: time.sleep(0.01) or b"jpg")
+    camera_config = {"index": 9, "mode": "none", "width": 64, "height": 48, "quality": 80,
+                     "encode_threads": 1, "encode_queue": 2}
+    config = {"recording_path": tmp_path, "camera": camera_config}
+    camera = derp.camera.Camera(config)
+    camera._cap = FakeCapture()
+    context, subscriber = derp.util.subscriber([derp.util.MSG_STEM + "camera"])
+    time.sleep(0.2)
+    create_times = []
+    for _ in range(20):
+        assert camera.run()
+        create_times.append(camera._timestamp)
+    time.sleep(0.1)
+    messages = []
+    while subscriber.poll(100):
+        topic, message_bytes = subscriber.recv_multipart()
+        if topic == b"camera":
+            messages.append(derp.util.parse_message(derp.util.TOPICS["camera"], message_bytes))
+    assert camera._dropped["camera"] + len(messages) == 20
+    assert camera._dropped["camera"] > 0
+    assert all(message.createNS in create_times for message in messages)
+    assert all(message.publishNS > message.createNS for message in messages)
+    encoders = camera._encoders
+    del camera
+    assert not any(encoder.is_alive() for encoder in encoders)
+    subscriber.close()
+    context.term()
+
+
+def test_async_encoding_order(tmp_path, monkeypatch):
+    """ verify frames from several encoder threads are still published in capture order """
+    delays = np.random.RandomState(0).uniform(0, 0.01, 1000)
+    delay_i = iter(range(1000))
+    monkeypatch.setattr(derp.util, "encode_jpg",
+                        lambda *args: time.sleep(delays[next(delay_i)]) or b"jpg")
+    camera_config = {"index": 8, "mode": "none", "width": 64, "height": 48, "quality": 80,
+                     "encode_threads": 3, "encode_queue": 4}
+    config = {"recording_path": tmp_path, "camera": camera_config}
+    camera = derp.camera.Camera(config)
+    camera._cap = FakeCapture()
+    context, subscriber = derp.util.subscriber([derp.util.MSG_STEM + "camera"])
+    time.sleep(0.2)
+    for _ in range(100):
+        assert camera.run()
+        time.sleep(0.002)
+    time.sleep(0.1)
+    create_times = []
+    while subscriber.poll(100):
+        topic, message_bytes = subscriber.recv_multipart()
+        if topic == b"camera":
+            message = derp.util.parse_message(derp.util.TOPICS["camera"], message_bytes)
+            create_times.append(message.createNS)
+    assert camera._dropped["camera"] + len(create_times) == 100
+    assert create_times == sorted(create_times)
+    del camera
+    subscriber.close()
+    context.term()
+
+
+def test_shutdown_with_short_queue(tmp_path, monkeypatch):
+    """ verify every encoder stops at shutdown even when the queue is shorter than the pool """
+    monkeypatch.setattr(derp.util, "encode_jpg", lambda *args: time.sleep(0.01) or b"jpg")
+    camera_config = {"index": 7, "mode": "none", "width": 64, "height": 48, "quality": 80,
+                     "encode_threads": 3, "encode_queue": 1}
+    config = {"recording_path": tmp_path, "camera": camera_config}
+    cameras = [derp.camera.Camera(config)]
+    cameras[0]._cap = FakeCapture()
+    for _ in range(10):
+        assert cameras[0].run()
+    encoders = cameras[0]._encoders
+    deleter = threading.Thread(target=cameras.clear, daemon=True)
+    deleter.start()
+    for thread in [deleter] + encoders:
+        thread.join(5)
+        assert not thread.is_alive()
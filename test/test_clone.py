@@ -0,0 +1,99 @@
+import importlib.util
+import os
+import pathlib
+import sys
+import numpy as np
+import pytest
+import derp.util
+
+# bin/clone.py is a script, registered as a module so the build pool can pickle its functions
+CLONE_SPEC = importlib.util.spec_from_file_location("clone", "bin/clone.py")
+clone = importlib.util.module_from_spec(CLONE_SPEC)
+sys.modules["clone"] = clone
+CLONE_SPEC.loader.exec_module(clone)
+
+
+def write_recording(folder, n_frames, seed):
+    """ A small recording with every topic the build reads """
+    rng = np.random.RandomState(seed)
+    config = derp.util.load_config(pathlib.Path("config/laptop.yaml"))
+    config["camera"].update(hfov=120, vfov=90, width=160, height=120)
+    folder.mkdir(parents=True)
+    derp.util.dump_config(config, folder / "config.yaml")
+    with derp.util.topic_file_writer(folder, "camera") as camera_fd:
+        with derp.util.topic_file_writer(folder, "quality") as quality_fd:
+            for i in range(n_frames):
+                frame = rng.randint(0, 256, (120, 160, 3)).astype(np.uint8)
+                derp.util.TOPICS["camera"].new_message(
+                    publishNS=1000 + i * 33, jpg=derp.util.encode_jpg(frame, 80)
+                ).write(camera_fd)
+                derp.util.TOPICS["quality"].new_message(
+                    publishNS=999 + i * 33, quality=["junk", "good"][i % 4 != 0]
+                ).write(quality_fd)
+    with derp.util.topic_file_writer(folder, "action") as action_fd:
+        for i in range(n_frames * 3):
+            derp.util.TOPICS["action"].new_message(
+                publishNS=1000 + i * 11, isManual=True, speed=float(rng.rand()),
+                steer=float(rng.rand())
+            ).write(action_fd)
+    with derp.util.topic_file_writer(folder, "controller") as controller_fd:
+        derp.util.TOPICS["controller"].new_message(publishNS=1000).write(controller_fd)
+
+
+@pytest.fixture
+def derp_root(tmp_path, monkeypatch):
+    """ Three recordings under a fresh root, so two train and one test """
+    for name, folder in [("MODEL_ROOT", "models"), ("RECORDING_ROOT", "recordings"),
+                         ("DATASET_ROOT", "datasets")]:
+        monkeypatch.setattr(derp.util, name, tmp_path / folder)
+    monkeypatch.setattr(derp.util, "CONFIG_ROOT", pathlib.Path("config"))
+    for i in range(3):
+        write_recording(derp.util.RECORDING_ROOT / ("recording-20200101-00000%i-host" % i),
+                        20 + i * 5, i)
+    return tmp_path
+
+
+@pytest.fixture
+def config():
+    return derp.util.load_config(pathlib.Path("config/brain-clone.yaml"))
+
+
+def test_incremental_build(derp_root, config, capsys):
+    """ verify only recordings whose files changed are rebuilt and stale builds can be pruned """
+    experiment_path = derp.util.MODEL_ROOT / "clone-test"
+    clone.build(config, experiment_path, 2)
+    assert "Build 3 of 3 recordings" in capsys.readouterr().out
+    assert len(list(derp.util.DATASET_ROOT.iterdir())) == 3
+    clone.build(config, experiment_path, 2)
+    assert "Build 0 of 3 recordings" in capsys.readouterr().out
+
+    action_path = derp.util.RECORDING_ROOT / "recording-20200101-000001-host" / "action.bin"
+    stat = action_path.stat()
+    os.utime(str(action_path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    clone.build(config, experiment_path, 2)
+    assert "Build 1 of 3 recordings" in capsys.readouterr().out
+    assert len(list(derp.util.DATASET_ROOT.iterdir())) == 4
+    clone.prune_datasets()
+    assert "Pruned 1 unused datasets" in capsys.readouterr().out
+    datasets = sorted(derp.util.DATASET_ROOT.iterdir())
+    links = sorted(path.resolve() for path in experiment_path.glob("*/recording-*"))
+    assert datasets == links
+    assert all((dataset / "manifest.yaml").exists() for dataset in datasets)
+
+
+@pytest.mark.parametrize("dataset_format", ["packed", "png"])
+def test_build_independent_of_chunks(derp_root, config, monkeypatch, dataset_format):
+    """ verify a dataset is byte identical whatever the pool size and chunk size """
+    config["build"]["format"] = dataset_format
+    contents = []
+    for count, chunk_size in [(1, 256), (3, 7)]:
+        monkeypatch.setattr(derp.util, "DATASET_ROOT", derp_root / ("datasets-%i" % count))
+        config["build"]["chunk_size"] = chunk_size
+        experiment_path = derp.util.MODEL_ROOT / ("clone-%i" % count)
+        clone.build(config, experiment_path, count)
+        files = {}
+        for path in sorted(experiment_path.glob("*/recording-*/*")):
+            files[str(path.relative_to(experiment_path))] = path.read_bytes()
+        contents.append(files)
+    assert len(contents[0]) > 6
+    assert contents[0] == contents[1]
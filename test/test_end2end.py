@@ -41,6 +41,47 @@ def test_perturb(frame, source_config, target_config):
     assert (zero_frame - frame).sum() == 0
 
 
+def legacy_perturb(frame, camera_config, shift=0, rotate=0):
+    """ The original per-row perturb loop, used as a reference """
+    pixels_per_degree = camera_config["width"] / camera_config["hfov"]
+    horizon_frac = ((camera_config["vfov"] / 2) + camera_config["pitch"]) / camera_config["vfov"]
+    for index, vertical_frac in enumerate(np.linspace(0, 1, len(frame))):
+        magnitude = rotate * pixels_per_degree
+        if vertical_frac > horizon_frac:
+            ground_angle = (vertical_frac - horizon_frac) * camera_config["vfov"]
+            ground_distance = camera_config["z"] / np.tan(derp.util.deg2rad(ground_angle))
+            half_hfov = derp.util.deg2rad(camera_config["hfov"]) / 2
+            ground_width = 2 * ground_distance * np.tan(half_hfov)
+            magnitude += (shift / ground_width) * camera_config["width"]
+        magnitude = int(magnitude + 0.5 * np.sign(magnitude))
+        if magnitude > 0:
+            frame[index, magnitude:, :] = frame[index, : frame.shape[1] - magnitude]
+            frame[index, :magnitude, :] = 0
+        elif magnitude < 0:
+            frame[index, :magnitude, :] = frame[index, abs(magnitude) :]
+            frame[index, frame.shape[1] + magnitude :] = 0
+    return frame
+
+
+def test_perturb_identical(frame, source_config):
+    """ verify the remapped perturb matches the original per-row loop pixel for pixel """
+    for shift in np.linspace(-0.4, 0.4, 9):
+        for rotate in np.linspace(-4, 4, 9):
+            expected = legacy_perturb(frame.copy(), source_config, shift, rotate)
+            perturbed = derp.util.perturb(frame.copy(), source_config, shift, rotate)
+            assert (perturbed != expected).sum() == 0
+
+
+def test_perturb_patch(frame, source_config, target_config):
+    """ verify warping only the bbox gives the same patch as perturbing then cropping """
+    bbox = derp.util.get_patch_bbox(target_config, source_config)
+    for shift, rotate in [(0, 0), (0.3, 0), (0, -3), (-0.2, 2.5)]:
+        expected = derp.util.crop(derp.util.perturb(frame.copy(), source_config, shift, rotate),
+                                  bbox)
+        patch = derp.util.perturb_patch(frame, source_config, bbox, shift, rotate)
+        assert (patch != expected).sum() == 0
+
+
 def test_perturb_learnability(frame, source_config, target_config):
     bbox = derp.util.get_patch_bbox(target_config, source_config)
     train_table, test_table = [], []
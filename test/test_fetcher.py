@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import torchvision.transforms as transforms
+import torch.utils.data
+from derp.fetcher import Fetcher, TensorLoader, make_loader
+import derp.util
+
+
+def write_recordings(root):
+    """ The same four items as a packed recording and as an image and csv recording """
+    thumbs = np.random.RandomState(0).randint(0, 256, (4, 32, 64, 3)).astype(np.uint8)
+    predicts = np.arange(8, dtype=np.float32).reshape(4, 2)
+    packed_path = root / "recording-a"
+    packed_path.mkdir()
+    np.save(str(packed_path / "thumbs.npy"), thumbs)
+    np.save(str(packed_path / "status.npy"), np.zeros((4, 0), dtype=np.float32))
+    np.save(str(packed_path / "predict.npy"), predicts)
+    csv_path = root / "recording-b"
+    csv_path.mkdir()
+    with open(str(csv_path / "status.csv"), "w") as status_fd:
+        with open(str(csv_path / "predict.csv"), "w") as predict_fd:
+            for i, (thumb, predict) in enumerate(zip(thumbs, predicts)):
+                derp.util.save_image(csv_path / ("%i.png" % i), thumb)
+                status_fd.write("%i.png\n" % i)
+                predict_fd.write("%i.png,%f,%f\n" % (i, *predict))
+
+
+def test_packed_and_csv(tmp_path):
+    """ verify packed recordings read back the same items as image and csv recordings """
+    write_recordings(tmp_path)
+    fetcher = Fetcher(tmp_path, transforms.ToTensor(), [])
+    assert len(fetcher) == 8
+    for i in range(4):
+        packed_thumb, packed_status, packed_predict = fetcher[i]
+        csv_thumb, csv_status, csv_predict = fetcher[i + 4]
+        assert (packed_thumb == csv_thumb).all()
+        assert np.array_equal(packed_status, csv_status)
+        assert np.array_equal(packed_predict, csv_predict)
+
+
+def test_tensor_loader(tmp_path):
+    """ verify in-memory batches match the ones a DataLoader collates """
+    write_recordings(tmp_path)
+    fetcher = Fetcher(tmp_path, transforms.ToTensor(), [])
+    tensor_batches = list(TensorLoader(fetcher, 3))
+    data_batches = list(torch.utils.data.DataLoader(fetcher, 3))
+    assert len(tensor_batches) == len(data_batches) == 3
+    for tensor_batch, data_batch in zip(tensor_batches, data_batches):
+        for tensor_part, data_part in zip(tensor_batch, data_batch):
+            assert torch.equal(tensor_part, data_part)
+
+
+def test_loader_keeps_transforms(tmp_path):
+    """ verify datasets with more than ToTensor to apply never load as tensors """
+    write_recordings(tmp_path)
+    fetcher = Fetcher(tmp_path, transforms.ToTensor(), [])
+    assert isinstance(make_loader(fetcher, 3, memory_budget=1 << 20), TensorLoader)
+    fetcher = Fetcher(tmp_path, transforms.Compose([transforms.ToTensor()]), [])
+    assert isinstance(make_loader(fetcher, 3, memory_budget=1 << 20), TensorLoader)
+    jitter = transforms.Compose([transforms.ColorJitter(brightness=0.5), transforms.ToTensor()])
+    fetcher = Fetcher(tmp_path, jitter, [])
+    loader = make_loader(fetcher, 3, memory_budget=1 << 20, num_workers=0)
+    assert isinstance(loader, torch.utils.data.DataLoader)
+    with pytest.raises(ValueError):
+        TensorLoader(fetcher, 3)
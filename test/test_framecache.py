@@ -0,0 +1,35 @@
+import time
+import numpy as np
+from derp.framecache import FrameCache
+
+
+def wait_for(cache, frame_ids):
+    deadline = time.time() + 5
+    while not all(frame_id in cache for frame_id in frame_ids) and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_frame_cache():
+    """ verify frames are prefetched in the direction of travel and evicted over budget """
+    loaded = []
+
+    def load(frame_id):
+        loaded.append(frame_id)
+        return np.full((4, 4, 3), frame_id, dtype=np.uint8)
+
+    cache = FrameCache(load, 100, max_bytes=48 * 10, ahead=4, behind=2, targets=[0, 99])
+    assert cache.get(50)[0, 0, 0] == 50
+    assert cache.n_misses == 1
+    cache.prefetch(50, direction=-1)
+    wait_for(cache, [0, 99, 49, 48, 47, 46, 51, 52])
+    assert all(frame_id in cache for frame_id in [0, 99, 49, 48, 47, 46, 51, 52])
+    assert cache.get(47)[0, 0, 0] == 47
+    assert cache.n_hits == 1
+
+    cache.prefetch(10, direction=1)
+    wait_for(cache, [11, 12, 13, 14])
+    assert len(cache) == 10
+    assert 0 in cache and 99 in cache and 14 in cache
+    assert 50 not in cache
+    cache.close()
+    assert loaded.count(47) == 1
@@ -0,0 +1,24 @@
+import numpy as np
+import derp.framering
+
+
+def test_frame_ring(tmp_path):
+    """ verify consumers see committed frames in place until the camera laps them """
+    path = tmp_path / "frames"
+    camera = derp.framering.FrameRing(path, (4, 6, 3), 3, create=True)
+    consumer = derp.framering.FrameRing(path, (4, 6, 3), 3)
+    for sequence in range(1, 6):
+        slot = camera.claim(sequence)
+        assert consumer.frame(sequence) is None
+        slot[...] = sequence
+        camera.commit(sequence, 100 * sequence)
+    for sequence in range(1, 3):
+        assert consumer.frame(sequence) is None
+    for sequence in range(3, 6):
+        frame = consumer.frame(sequence)
+        assert np.all(frame == sequence)
+        assert not frame.flags.writeable
+    frame = consumer.frame(3)
+    camera.claim(6)
+    assert not consumer.is_current(3)
+    assert consumer.is_current(5)
@@ -0,0 +1,34 @@
+import pathlib
+import numpy as np
+import derp.jpeg
+
+
+def sampling_factors(jpg):
+    """ The packed sampling factors of each component from the jpg's start of frame marker """
+    offset = 2
+    while jpg[offset + 1] not in (0xC0, 0xC1, 0xC2):
+        offset += 2 + int.from_bytes(jpg[offset + 2 : offset + 4], "big")
+    n_components = jpg[offset + 9]
+    return [jpg[offset + 11 + 3 * i] for i in range(n_components)]
+
+
+def test_codecs_agree():
+    """ verify every available codec decodes reduced and into buffers like opencv does """
+    reference = derp.jpeg.OpenCVCodec()
+    image = reference.decode((pathlib.Path(__file__).parent / "track.jpg").read_bytes())
+    jpg = reference.encode(image, 80)
+    for name in derp.jpeg.CODECS:
+        try:
+            codec = derp.jpeg.make_codec(name)
+        except (RuntimeError, OSError):
+            continue
+        for reduction in (1, 2, 4, 8):
+            expected = reference.decode(jpg, reduction)
+            assert expected.shape == derp.jpeg.reduced_shape(image.shape, reduction)
+            out = np.empty_like(expected)
+            assert codec.decode(jpg, reduction, out) is out
+            assert np.abs(out.astype(int) - expected).max() <= 1
+        assert codec.decode(codec.encode(image, 80)).shape == image.shape
+        # Every codec subsamples chroma 4:2:0 like opencv
+        assert sampling_factors(jpg) == [0x22, 0x11, 0x11]
+        assert sampling_factors(codec.encode(image, 80)) == sampling_factors(jpg)
@@ -0,0 +1,145 @@
+import pathlib
+import cv2
+import numpy as np
+import pytest
+import torch
+import torchvision.transforms.functional as F
+import derp.brain
+import derp.framering
+import derp.inference
+import derp.model
+import derp.util
+
+
+@pytest.fixture
+def runtime():
+    """ derp.runtime, skipping the test when onnxruntime is not installed """
+    return pytest.importorskip("derp.runtime")
+
+
+def test_batch_color_jitter_matches_torchvision():
+    """ verify the batched color adjustments agree with torchvision's per-image ones """
+    torch.manual_seed(0)
+    batch = torch.rand(4, 3, 32, 64)
+    hsv = derp.model.rgb_to_hsv(batch)
+    assert torch.allclose(derp.model.hsv_to_rgb(hsv), batch, atol=1e-5)
+    shifted = torch.cat(((hsv[:, :1] + 0.1) % 1.0, hsv[:, 1:]), 1)
+    expected = torch.stack([F.adjust_hue(image, 0.1) for image in batch])
+    assert torch.allclose(derp.model.hsv_to_rgb(shifted), expected, atol=1e-5)
+    gray = derp.model.rgb_to_grayscale(batch)
+    expected = torch.stack([F.adjust_saturation(image, 0.5) for image in batch])
+    assert torch.allclose(0.5 * batch + 0.5 * gray, expected, atol=1e-4)
+
+
+def test_batch_color_jitter_ranges():
+    """ verify jittered float and uint8 batches keep their shape, type and range """
+    jitter = derp.model.BatchColorJitter(brightness=0.5, contrast=0.5, saturation=0.5, hue=0.1)
+    batch = torch.rand(8, 3, 32, 64)
+    out = jitter(batch)
+    assert out.shape == batch.shape and out.min() >= 0 and out.max() <= 1
+    out = jitter((batch * 255).to(torch.uint8))
+    assert out.dtype == torch.uint8 and out.shape == batch.shape
+
+
+def test_inference_engine_matches_eager():
+    """ verify the frozen engine predicts what the eager model does on uint8 thumbs """
+    torch.manual_seed(0)
+    model = derp.model.Tiny(np.array([3, 32, 64]), 0, 2).eval()
+    engine = derp.inference.InferenceEngine(model, {"height": 32, "width": 64, "depth": 3}, 0,
+                                            torch.device("cpu"))
+    thumbs = np.random.RandomState(0).randint(0, 256, (5, 32, 64, 3)).astype(np.uint8)
+    for thumb in thumbs:
+        batch = torch.from_numpy(thumb.transpose(2, 0, 1)[None] / 255).float().contiguous()
+        with torch.no_grad():
+            expected = model(batch, torch.zeros(1, 0)).numpy()[0]
+        assert np.allclose(engine.predict(thumb), expected, atol=1e-6)
+    assert engine.n_predictions == len(thumbs)
+    assert len(engine.latency_percentiles()) == 3
+
+
+def test_onnx_engine_matches_torch(tmp_path, runtime):
+    """ verify an exported model runs through onnxruntime like it does in torch """
+    torch.manual_seed(0)
+    thumb_config = {"height": 32, "width": 64, "depth": 3}
+    model = derp.model.Tiny(np.array([3, 32, 64]), 0, 2).eval()
+    derp.inference.export_onnx(model, thumb_config, 0, tmp_path / "model.onnx")
+    onnx_engine = runtime.OnnxEngine(tmp_path / "model.onnx", 0)
+    torch_engine = derp.inference.InferenceEngine(model, thumb_config, 0, torch.device("cpu"))
+    thumbs = np.random.RandomState(0).randint(0, 256, (5, 32, 64, 3)).astype(np.uint8)
+    for thumb in thumbs:
+        assert np.allclose(onnx_engine.predict(thumb), torch_engine.predict(thumb), atol=1e-5)
+
+
+def test_quantize_static():
+    """ verify the calibrated int8 copy of each model stays close to the float model """
+    torch.manual_seed(0)
+    for model_fn, n_status in [(derp.model.Tiny, 0), (derp.model.StarTree, 2)]:
+        model = model_fn(np.array([3, 32, 64]), n_status, 2).eval()
+        batches = [(torch.rand(8, 3, 32, 64), torch.rand(8, n_status), None) for _ in range(4)]
+        quantized = derp.model.quantize_static(model, batches, 4)
+        batch, status, _ = batches[0]
+        with torch.no_grad():
+            error = (quantized(batch, status) - model(batch, status)).abs().max()
+        assert error < 0.01
+
+
+def test_clone_backends(tmp_path, monkeypatch, runtime):
+    """ verify the clone brain loads and drives a model through the torch and onnx backends """
+    monkeypatch.setattr(derp.util, "CONFIG_ROOT", pathlib.Path("config"))
+    brain_config = derp.util.load_config(pathlib.Path("config/brain-clone.yaml"))
+    brain_config["name"] = "clone-test"
+    camera_config = derp.util.load_config(pathlib.Path("config/laptop.yaml"))["camera"]
+    camera_config.update(hfov=120, vfov=90)
+    config = {"brain": brain_config, "camera": camera_config, "recording_path": tmp_path}
+    monkeypatch.setattr(derp.util, "MODEL_ROOT", tmp_path)
+    model_folder = tmp_path / "clone-test"
+    model_folder.mkdir()
+    torch.manual_seed(0)
+    model = derp.model.Tiny(np.array([3, 32, 64]), 0, 2).eval()
+    torch.save(model, str(model_folder / "model.pt"))
+    derp.inference.export_onnx(model, brain_config["thumb"], 0, model_folder / "model.onnx")
+    frame = np.random.RandomState(0).randint(0, 256, (480, 640, 3)).astype(np.uint8)
+    jpg = cv2.imencode(".jpg", frame)[1].tobytes()
+    predictions = []
+    for backend in ("torch", "onnx"):
+        brain_config["backend"] = backend
+        clone = derp.brain.Clone(config)
+        assert clone.engine is not None
+        clone._messages["camera"].jpg = jpg
+        assert clone.predict("camera")
+        predictions.append((clone.steer, clone.speed))
+        del clone
+    assert np.allclose(predictions[0], predictions[1], atol=1e-5)
+
+
+def test_clone_transports_match(tmp_path, monkeypatch):
+    """ verify shared and jpg frames give the same thumb when the build decoded reduced """
+    monkeypatch.setattr(derp.util, "CONFIG_ROOT", pathlib.Path("config"))
+    brain_config = derp.util.load_config(pathlib.Path("config/brain-clone.yaml"))
+    brain_config["name"] = "clone-test"
+    brain_config["build"]["reduce"] = True
+    camera_config = derp.util.load_config(pathlib.Path("config/laptop.yaml"))["camera"]
+    camera_config.update(hfov=120, vfov=90, index=7)
+    config = {"brain": brain_config, "camera": camera_config, "recording_path": tmp_path}
+    monkeypatch.setattr(derp.util, "MODEL_ROOT", tmp_path)
+    (tmp_path / "clone-test").mkdir()
+    torch.save(derp.model.Tiny(np.array([3, 32, 64]), 0, 2).eval(),
+               str(tmp_path / "clone-test" / "model.pt"))
+    clone = derp.brain.Clone(config)
+    assert clone.reduction > 1
+    thumbs = []
+    clone.engine.predict = lambda thumb, status=(): thumbs.append(thumb.copy()) or np.zeros(2)
+    pixels = np.random.RandomState(0).randint(0, 256, (60, 80, 3)).astype(np.uint8)
+    frame = cv2.resize(pixels, (640, 480))
+    ring = derp.framering.create_ring(camera_config)
+    try:
+        ring.claim(1)[...] = frame
+        ring.commit(1, 5)
+        clone._messages["frame"].sequence = 1
+        assert clone.predict("frame")
+    finally:
+        ring.path.unlink()
+    clone._messages["camera"].jpg = derp.util.encode_jpg(frame, 100)
+    assert clone.predict("camera")
+    assert np.abs(thumbs[0].astype(int) - thumbs[1]).mean() < 1
+    del clone
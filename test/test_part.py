@@ -0,0 +1,32 @@
+import time
+import zmq
+import derp.part
+import derp.util
+
+
+def test_conflated_subscribe(tmp_path):
+    """ verify only the newest queued camera frame is handled and the rest are counted """
+    config = {"recording_path": tmp_path, "conflate-test": {"conflate": ["camera"]}}
+    context, publisher = derp.util.publisher(derp.util.MSG_STEM + "camera-test")
+    publisher.setsockopt(zmq.LINGER, 0)
+    part = None
+    try:
+        part = derp.part.Part(config, "conflate-test", ["camera-test"])
+        time.sleep(0.2)
+        for index in range(5):
+            message = derp.util.TOPICS["camera"].new_message(index=index)
+            publisher.send_multipart([b"camera", message.to_bytes()])
+        message = derp.util.TOPICS["controller"].new_message(speedOffset=0.5)
+        publisher.send_multipart([b"controller", message.to_bytes()])
+        time.sleep(0.2)
+
+        assert part.subscribe() == "camera"
+        assert part._messages["camera"].index == 4
+        assert part.subscribe() == "controller"
+        assert part._dropped["camera"] == 4
+    finally:
+        # A context left open by a failed assert would hang every later test at exit
+        if part is not None:
+            part.close()
+        publisher.close()
+        context.term()
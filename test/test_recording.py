@@ -0,0 +1,127 @@
+import numpy as np
+import pytest
+import derp.recording
+import derp.util
+import bench_extract
+
+
+@pytest.fixture
+def recording(tmp_path):
+    with derp.util.topic_file_writer(tmp_path, "camera") as camera_fd:
+        for i in range(10):
+            msg = derp.util.TOPICS["camera"].new_message(publishNS=100 * i, jpg=b"x" * i)
+            msg.write(camera_fd)
+    with derp.util.topic_file_writer(tmp_path, "action") as action_fd:
+        for i in range(5):
+            msg = derp.util.TOPICS["action"].new_message(publishNS=150 * i, speed=i)
+            msg.write(action_fd)
+    return tmp_path
+
+
+def test_topic_reader(recording):
+    """ verify lazy reads match an eager read of every message """
+    eager = derp.util.load_topics(recording)
+    lazy = derp.recording.open_topics(recording)
+    assert sorted(lazy) == sorted(eager)
+    for topic in eager:
+        assert len(lazy[topic]) == len(eager[topic])
+        for lazy_msg, eager_msg in zip(lazy[topic], eager[topic]):
+            assert lazy_msg.to_dict() == eager_msg.to_dict()
+    assert lazy["camera"][-1].jpg == b"x" * 9
+    assert [msg.publishNS for msg in lazy["camera"].between(250, 500)] == [300, 400]
+    assert derp.recording.index_path(recording, "camera").exists()
+
+
+def test_topic_reader_torn_tail(recording):
+    """ verify a partially written last message is ignored """
+    camera_path = recording / "camera.bin"
+    with open(str(camera_path), "r+b") as camera_fd:
+        camera_fd.truncate(camera_path.stat().st_size - 3)
+    reader = derp.recording.TopicReader(recording, "camera")
+    assert len(reader) == 9
+    assert reader[8].publishNS == 800
+
+
+def test_torn_sidecars(recording):
+    """ verify half-written or empty sidecar caches are rebuilt instead of crashing """
+    derp.recording.TopicReader(recording, "action").close()
+    derp.recording.load_columns(recording, "action")
+    for path in (derp.recording.index_path(recording, "action"),
+                 derp.recording.columns_path(recording, "action")):
+        with open(str(path), "r+b") as sidecar_fd:
+            sidecar_fd.truncate(path.stat().st_size // 2)
+    assert len(derp.recording.TopicReader(recording, "action")) == 5
+    assert len(derp.recording.load_columns(recording, "action")["speed"]) == 5
+    for path in (derp.recording.index_path(recording, "action"),
+                 derp.recording.columns_path(recording, "action")):
+        path.write_bytes(b"")
+    assert len(derp.recording.TopicReader(recording, "action")) == 5
+    assert len(derp.recording.load_columns(recording, "action")["speed"]) == 5
+
+
+def test_packed_topic(recording):
+    """ verify a repacked topic reads back the same messages through every reader """
+    pytest.importorskip("zstandard")
+    eager = derp.util.load_topics(recording)
+    assert derp.util.write_packed_topic(recording, "action", eager["action"], chunk_size=2) == 5
+    (recording / "action.bin").unlink()
+    assert derp.util.topic_exists(recording, "action")
+    repacked = derp.util.load_topics(recording)["action"]
+    lazy = derp.recording.TopicReader(recording, "action")
+    assert len(lazy) == len(repacked) == 5
+    for lazy_msg, repacked_msg, msg in zip(lazy, repacked, eager["action"]):
+        assert lazy_msg.to_dict() == repacked_msg.to_dict() == msg.to_dict()
+    assert list(derp.recording.load_columns(recording, "action")["speed"]) == [0, 1, 2, 3, 4]
+
+
+def test_packed_topic_without_zstandard(recording, monkeypatch):
+    """ verify packed topics name the missing package instead of failing on None """
+    messages = derp.util.load_topics(recording)["action"]
+    monkeypatch.setattr(derp.util, "zstandard", None)
+    with pytest.raises(RuntimeError, match="zstandard"):
+        derp.util.write_packed_topic(recording, "action", messages)
+    with pytest.raises(RuntimeError, match="zstandard"):
+        derp.util.read_packed_topic(recording, "action")
+
+
+def test_replay(recording):
+    """ verify the streaming replay merges lazy topics in publish order within bounds """
+    topics = derp.recording.open_topics(recording)
+    replayed = [(timestamp, topic) for timestamp, topic, _ in derp.util.replay(topics)]
+    assert replayed == sorted(replayed)
+    assert len(replayed) == 15
+    bounded = derp.util.replay(topics, start=300, end=600, names=["action"])
+    assert [timestamp for timestamp, _, _ in bounded] == [300, 450]
+
+
+def test_extract_car_actions():
+    """ verify the vectorized extraction matches the original replay loop exactly """
+    topics = bench_extract.synthetic_topics(5000)
+    actions = derp.util.extract_car_actions(topics)
+    assert np.array_equal(actions, bench_extract.legacy_extract_car_actions(topics))
+    camera_times = [msg.publishNS for msg in topics["camera"]]
+    speeds = derp.util.extract_latest(camera_times, actions[:, 0], actions[:, 1])
+    legacy_speeds = bench_extract.legacy_extract_latest(camera_times, actions[:, 0], actions[:, 1])
+    assert np.array_equal(speeds, legacy_speeds)
+
+
+def test_columns_cache(recording):
+    """ verify scalar topics are cached as typed columns and rebuilt when the topic changes """
+    columns = derp.recording.load_columns(recording, "action")
+    assert columns["speed"].dtype == np.float32
+    assert list(columns["publishNS"]) == [0, 150, 300, 450, 600]
+    assert derp.recording.columns_path(recording, "action").exists()
+    assert len(derp.recording.load_columns(recording, "imu")["gravity"].shape) == 2
+    with derp.util.topic_file_writer(recording, "action") as action_fd:
+        derp.util.TOPICS["action"].new_message(publishNS=7, isManual=True).write(action_fd)
+    columns = derp.recording.load_columns(recording, "action")
+    assert list(columns["publishNS"]) == [7]
+    assert np.array_equal(derp.recording.load_car_actions(recording), [[7, 0, 0]])
+
+
+def test_column_aggregate():
+    """ verify values are binned into pixel columns like the labeler's frame positions """
+    values = np.arange(10)
+    assert list(derp.util.column_aggregate(values, 4)) == [1, 3.5, 6, 8.5]
+    assert list(derp.util.column_aggregate(values, 4, np.maximum)) == [2, 4, 7, 9]
+    assert list(derp.util.column_aggregate([3, 1], 4, np.minimum)) == [3, 1, 1, 1]
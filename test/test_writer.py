@@ -0,0 +1,84 @@
+import logging
+import os
+import numpy as np
+import derp.framering
+import derp.recording
+import derp.util
+import derp.writer
+
+
+def test_batch_writer(tmp_path):
+    """ verify batched messages all reach their topic files in order once the writer closes """
+    files = {topic: derp.util.topic_file_writer(tmp_path, topic) for topic in ("camera", "action")}
+    batch = derp.writer.BatchWriter(files, logging.getLogger("test"), buffer_sizes={"camera": 64},
+                                    fsync_interval=0.01, stats_interval=0.01)
+    for i in range(100):
+        msg = derp.util.TOPICS["camera"].new_message(publishNS=i, jpg=b"x" * i)
+        batch.put("camera", msg.to_bytes())
+        msg = derp.util.TOPICS["action"].new_message(publishNS=i, speed=i)
+        batch.put("action", msg.to_bytes())
+    batch.close()
+    assert batch.n_dropped == 0
+    camera = derp.recording.TopicReader(tmp_path, "camera")
+    assert list(camera.times) == list(range(100))
+    assert camera[42].jpg == b"x" * 42
+    action = derp.recording.TopicReader(tmp_path, "action")
+    assert [msg.speed for msg in action] == list(range(100))
+
+
+def test_segments_and_torn_tail(tmp_path):
+    """ verify committed segments bound the torn tail, which truncate_torn cuts off """
+    files = {"action": derp.util.topic_file_writer(tmp_path, "action")}
+    segment_files = {"action": open(str(derp.recording.segments_path(tmp_path, "action")), "wb")}
+    batch = derp.writer.BatchWriter(files, logging.getLogger("test"), fsync_interval=0.01,
+                                    segment_files=segment_files, segment_size=200)
+    for i in range(50):
+        batch.put("action", derp.util.TOPICS["action"].new_message(publishNS=i).to_bytes())
+    batch.close()
+    path = tmp_path / "action.bin"
+    size = path.stat().st_size
+    assert derp.recording.committed_segment(tmp_path, "action") == (size, 50)
+
+    # A crash can leave zeroed space or a torn message and a torn record behind
+    with open(str(path), "ab") as action_fd:
+        action_fd.write(bytes(64))
+    assert derp.recording.topic_end(tmp_path, "action") == size
+    os.truncate(str(path), size)
+    with open(str(path), "ab") as action_fd:
+        action_fd.write(derp.util.TOPICS["action"].new_message(publishNS=50).to_bytes()[:-3])
+    with open(str(derp.recording.segments_path(tmp_path, "action")), "ab") as segments_fd:
+        segments_fd.write(derp.recording.segment_record(size + 100, 51)[:-2])
+    assert derp.recording.committed_segment(tmp_path, "action") == (size, 50)
+    assert derp.recording.topic_end(tmp_path, "action") == size
+    assert len(derp.recording.TopicReader(tmp_path, "action")) == 50
+    torn_size = path.stat().st_size
+    assert derp.recording.truncate_torn(tmp_path, "action") == torn_size - size
+    assert path.stat().st_size == size
+    assert derp.recording.truncate_torn(tmp_path, "action") == 0
+
+
+def test_write_shared_frames(tmp_path):
+    """ verify frames shared through the ring are encoded off the subscriber and recorded """
+    camera_config = {"index": 6, "width": 64, "height": 48, "depth": 3, "quality": 95,
+                     "slots": 4}
+    config = {"recording_path": tmp_path, "camera": camera_config,
+              "writer": {"fsync_interval": 0.01, "stats_interval": 0}}
+    ring = derp.framering.create_ring(camera_config)
+    writer = derp.writer.Writer(config)
+    try:
+        for sequence in range(1, 4):
+            ring.claim(sequence)[...] = sequence * 60
+            ring.commit(sequence, sequence * 100)
+            frame_msg = derp.util.TOPICS["frame"].new_message(
+                createNS=sequence * 100, publishNS=sequence * 100 + 1, index=6, sequence=sequence
+            )
+            writer.write_frame(frame_msg)
+        del writer
+    finally:
+        ring.path.unlink()
+    camera = derp.recording.TopicReader(tmp_path, "camera")
+    assert list(camera.times) == [101, 201, 301]
+    for sequence, msg in enumerate(camera, 1):
+        assert msg.createNS == sequence * 100
+        frame = derp.util.decode_jpg(msg.jpg)
+        assert np.abs(frame.astype(int) - sequence * 60).max() <= 2